@@ -1,8 +1,20 @@
 from flask import Flask, request, jsonify, render_template, redirect, url_for
-import mysql.connector
-import mysql.connector.errorcode
+import click
+import duckdb
+import functools
+import json
+import math
 import os
+import pyarrow as pa
+import threading
+import time
+import urllib.request
+import weakref
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from dotenv import load_dotenv
+from storage import MySQLBackend, SQLiteBackend
 load_dotenv()
 
 app = Flask(__name__)
@@ -10,24 +22,216 @@ app = Flask(__name__)
 # Set up database credentials using environment variables
 DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
+DB_CONFIG = {
+    'host': os.environ.get('DB_HOST', 'localhost'),
+    'user': DB_USER,
+    'password': DB_PASSWORD,
+    'database': 'warehouse',
+}
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+
+# Storage engine: 'mysql', or 'sqlite' for sites without a MySQL server. A
+# SQLite site pushes its transactions and orders to the MySQL database in
+# DB_CONFIG with `flask sync-upstream`, under a SITE_ID unique to the site.
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mysql')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'warehouse.sqlite3')
+SITE_ID = os.environ.get('SITE_ID')
+
+# Local columnar store used by the reports, so analytical queries never hit MySQL
+REPORTS_DB_PATH = os.environ.get('REPORTS_DB_PATH', 'reports.duckdb')
+
+if DB_BACKEND == 'sqlite':
+    db_backend = SQLiteBackend(SQLITE_PATH, DB_POOL_SIZE)
+else:
+    db_backend = MySQLBackend(DB_CONFIG, DB_POOL_SIZE)
+dialect = db_backend.dialect
 
 def get_db_connection():
+    return db_backend.connect()
+
+# **Data access**
+
+# A fixed statement. Rows come back as namedtuples built from the statement's
+# columns, which Jinja templates read like the dictionaries they replace.
+class Query:
+    __slots__ = ('sql', 'record')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.record = None
+
+# Prepared cursors per session, one per statement, so each statement is
+# parsed once per session instead of on every execution
+prepared_statements = weakref.WeakKeyDictionary()
+
+def prepared_cursor(conn, query):
+    cnx = getattr(conn, '_cnx', conn)
+    session_id, cursors = prepared_statements.get(cnx, (None, None))
+    # A reconnected session has lost its statements
+    if session_id != cnx.connection_id:
+        cursors = {}
+        prepared_statements[cnx] = (cnx.connection_id, cursors)
+    cursor = cursors.get(query.sql)
+    if cursor is None:
+        cursor = cursors[query.sql] = conn.cursor(prepared=True)
+    return cursor
+
+def execute(conn, query, params=()):
+    cursor = prepared_cursor(conn, query)
+    cursor.execute(query.sql, params)
+    return cursor
+
+def fetch_all(conn, query, params=()):
+    cursor = execute(conn, query, params)
+    rows = cursor.fetchall()
+    if query.record is None:
+        query.record = namedtuple('Row', cursor.column_names, rename=True)
+    return list(map(query.record._make, rows))
+
+def fetch_one(conn, query, params=()):
+    rows = fetch_all(conn, query, params)
+    return rows[0] if rows else None
+
+# **Admission control**
+
+# Limits per route class: token bucket refill rate (tokens per second) and
+# burst size per client, plus a concurrency cap shared by all clients with a
+# short bounded queue. Routes without a class are never throttled.
+ROUTE_CLASSES = {
+    'list': {'rate': 5, 'burst': 20, 'concurrency': 4, 'queue': 8, 'queue_timeout': 2.0},
+    'order_write': {'rate': 5, 'burst': 50, 'concurrency': 4, 'queue': 8, 'queue_timeout': 5.0},
+    # Burst above SNAPSHOT_COST, so a client can still read reports right after a snapshot
+    'reports': {'rate': 1, 'burst': 20, 'concurrency': 2, 'queue': 4, 'queue_timeout': 5.0},
+    'feed': {'rate': 2, 'burst': 10, 'concurrency': 16, 'queue': 0, 'queue_timeout': 0},
+    # Event streams hold their slot for as long as the client stays connected,
+    # so they are capped apart from the long-poll feed
+    'stream': {'rate': 1, 'burst': 5, 'concurrency': 8, 'queue': 0, 'queue_timeout': 0},
+}
+
+# Buckets of idle clients are dropped once this many clients are tracked
+MAX_TRACKED_CLIENTS = 10000
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+# Rows of a list page covered by one token
+ROWS_PER_TOKEN = 100
+# Order lines covered by one token, on top of one token per order
+ITEMS_PER_TOKEN = 10
+# Tokens taken by a reports snapshot
+SNAPSHOT_COST = 10
+
+class RouteGate:
+    def __init__(self, rate, burst, concurrency, queue, queue_timeout):
+        self.rate = rate
+        self.burst = burst
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.waiting = 0
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # Take tokens from the client's bucket; returns seconds to wait when empty
+    def take(self, client, cost):
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < cost:
+                self.buckets[client] = (tokens, now)
+                return (cost - tokens) / self.rate
+            self.buckets[client] = (tokens - cost, now)
+            if len(self.buckets) > MAX_TRACKED_CLIENTS:
+                self.prune(now)
+        return 0
+
+    def prune(self, now):
+        for client, (tokens, updated) in list(self.buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self.buckets[client]
+
+    # Wait for a concurrency slot; False when the queue is full or the wait timed out
+    def enter(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def leave(self):
+        self.slots.release()
+
+route_gates = {name: RouteGate(**limits) for name, limits in ROUTE_CLASSES.items()}
+
+def page_cost():
     try:
-        conn = mysql.connector.connect(
-            host='localhost',
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database='warehouse'
-        )
-        return conn
-    except mysql.connector.Error as err:
-        if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
-            print("Authentication error: Invalid username or password")
-        elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-            print("Database does not exist")
-        else:
-            print(f'Database connection error: {err}')
-        return None
+        per_page = int(request.args.get('per_page', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        per_page = DEFAULT_PAGE_SIZE
+    return math.ceil(min(max(per_page, 1), MAX_PAGE_SIZE) / ROWS_PER_TOKEN)
+
+def order_cost():
+    return 1 + len(request.form.getlist('product_id[]')) // ITEMS_PER_TOKEN
+
+# One page of a list query, newest first; one row past the page is fetched to
+# tell whether there is a next page
+def fetch_page(conn, query, page, per_page):
+    rows = fetch_all(conn, query, (per_page + 1, (page - 1) * per_page))
+    return rows[:per_page], len(rows) > per_page
+
+def get_page_args():
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        page, per_page = 1, DEFAULT_PAGE_SIZE
+    return page, per_page
+
+# Throttle a route: 429 when the client is over its rate, 503 when the route
+# class is saturated. `cost` estimates the request's weight in tokens.
+def admission_control(route_class, cost=None):
+    gate = route_gates[route_class]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request_cost = cost() if cost is not None else 1
+            retry_after = gate.take(request.remote_addr, request_cost)
+            if retry_after:
+                return jsonify({'error': 'Rate limit exceeded'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+            if not gate.enter():
+                return jsonify({'error': 'Server busy, try again shortly'}), 503, {'Retry-After': '1'}
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                gate.leave()
+                raise
+            # Streamed responses keep their slot until the client goes away
+            if response.is_streamed:
+                response.call_on_close(gate.leave)
+            else:
+                gate.leave()
+            return response
+        return wrapper
+    return decorator
+
+# Customers, suppliers, categories and products are managed centrally. A
+# SQLite site only reads them: `flask pull-catalog` copies them down with
+# their central ids, which the rows the site syncs upstream refer to.
+def central_catalog(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if DB_BACKEND == 'sqlite' and request.method == 'POST':
+            return jsonify({'error': 'The catalog is managed centrally, run flask pull-catalog'}), 403
+        return view(*args, **kwargs)
+    return wrapper
 
 # Home page
 @app.route('/')
@@ -41,18 +245,23 @@ def view_index():
 
 # **Customers**
 
+CUSTOMERS_QUERY = Query('SELECT id, name, contact_info FROM customers')
+CUSTOMER_QUERY = Query('SELECT id, name, contact_info FROM customers WHERE id = %s')
+INSERT_CUSTOMER_QUERY = Query('INSERT INTO customers (name, contact_info) VALUES (%s, %s)')
+UPDATE_CUSTOMER_QUERY = Query('UPDATE customers SET name = %s, contact_info = %s WHERE id = %s')
+DELETE_CUSTOMER_QUERY = Query('DELETE FROM customers WHERE id = %s')
+
 # View all customers
 @app.route('/customers', methods=['GET'])
 def view_customers():
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT * FROM customers')
-    customers_list = cursor.fetchall()
+    customers_list = fetch_all(conn, CUSTOMERS_QUERY)
     conn.close()
     return render_template('customers.html', customers=customers_list)
 
 # Add a new customer
 @app.route('/add_customer', methods=['GET', 'POST'])
+@central_catalog
 def add_customer():
     if request.method == 'POST':
         name = request.form.get('name')
@@ -62,8 +271,7 @@ def add_customer():
             return jsonify({'error': 'Invalid customer data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO customers (name, contact_info) VALUES (%s, %s)', (name, contact_info))
+        execute(conn, INSERT_CUSTOMER_QUERY, (name, contact_info))
         conn.commit()
         conn.close()
         return redirect(url_for('view_customers'))
@@ -72,23 +280,23 @@ def add_customer():
 
 # Edit an existing customer
 @app.route('/edit_customer/<int:customer_id>', methods=['GET', 'POST'])
+@central_catalog
 def edit_customer(customer_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     if request.method == 'POST':
         name = request.form.get('name')
         contact_info = request.form.get('contact_info')
 
         if not name or not contact_info:
+            conn.close()
             return jsonify({'error': 'Invalid customer data'}), 400
 
-        cursor.execute('UPDATE customers SET name = %s, contact_info = %s WHERE id = %s', (name, contact_info, customer_id))
+        execute(conn, UPDATE_CUSTOMER_QUERY, (name, contact_info, customer_id))
         conn.commit()
         conn.close()
         return redirect(url_for('view_customers'))
     else:
-        cursor.execute('SELECT * FROM customers WHERE id = %s', (customer_id,))
-        customer = cursor.fetchone()
+        customer = fetch_one(conn, CUSTOMER_QUERY, (customer_id,))
         conn.close()
         if customer is None:
             return jsonify({'error': 'Customer not found'}), 404
@@ -96,33 +304,53 @@ def edit_customer(customer_id):
 
 # Delete a customer
 @app.route('/delete_customer/<int:customer_id>', methods=['POST'])
+@central_catalog
 def delete_customer(customer_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM customers WHERE id = %s', (customer_id,))
+    execute(conn, DELETE_CUSTOMER_QUERY, (customer_id,))
     conn.commit()
     conn.close()
     return redirect(url_for('view_customers'))
 
 # **Products**
 
+PRODUCTS_QUERY = Query('''
+    SELECT products.id, products.name, categories.name AS category, products.quantity, products.unit_price, suppliers.name AS supplier
+    FROM products
+    LEFT JOIN categories ON products.category_id = categories.id
+    LEFT JOIN suppliers ON products.supplier_id = suppliers.id
+''')
+PRODUCT_QUERY = Query('SELECT id, name, category_id, quantity, unit_price, supplier_id FROM products WHERE id = %s')
+# Products offered in the transaction and order forms
+PRODUCT_OPTIONS_QUERY = Query('SELECT id, name, quantity, unit_price FROM products')
+INSERT_PRODUCT_QUERY = Query('INSERT INTO products (name, category_id, quantity, unit_price, supplier_id) VALUES (%s, %s, %s, %s, %s)')
+UPDATE_PRODUCT_QUERY = Query('''
+    UPDATE products
+    SET name = %s, category_id = %s, quantity = %s, unit_price = %s, supplier_id = %s
+    WHERE id = %s
+''')
+DELETE_PRODUCT_QUERY = Query('DELETE FROM products WHERE id = %s')
+ADD_STOCK_QUERY = Query('UPDATE products SET quantity = quantity + %s WHERE id = %s')
+REMOVE_STOCK_QUERY = Query('UPDATE products SET quantity = quantity - %s WHERE id = %s')
+UNIT_PRICE_QUERY = Query('SELECT unit_price FROM products WHERE id = %s')
+PRODUCT_QUANTITY_QUERY = Query(f'SELECT quantity FROM products WHERE id = %s{dialect.for_update}')
+# Opening balances the stock audit reconciles products.quantity against
+INSERT_STOCK_OPENING_QUERY = Query('INSERT INTO stock_openings (product_id, quantity) VALUES (%s, %s)')
+ADJUST_STOCK_OPENING_QUERY = Query('UPDATE stock_openings SET quantity = quantity + %s WHERE product_id = %s')
+DELETE_STOCK_OPENING_QUERY = Query('DELETE FROM stock_openings WHERE product_id = %s')
+DELETE_MOVEMENT_SUM_QUERY = Query('DELETE FROM stock_movement_sums WHERE product_id = %s')
+
 # View all products
 @app.route('/products', methods=['GET'])
 def view_products():
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('''
-        SELECT products.id, products.name, categories.name AS category, products.quantity, products.unit_price, suppliers.name AS supplier
-        FROM products
-        LEFT JOIN categories ON products.category_id = categories.id
-        LEFT JOIN suppliers ON products.supplier_id = suppliers.id
-    ''')
-    products_list = cursor.fetchall()
+    products_list = fetch_all(conn, PRODUCTS_QUERY)
     conn.close()
     return render_template('products.html', products=products_list)
 
 # Add a new product
 @app.route('/add_product', methods=['GET', 'POST'])
+@central_catalog
 def add_product():
     if request.method == 'POST':
         name = request.form.get('name')
@@ -135,27 +363,26 @@ def add_product():
             return jsonify({'error': 'Invalid product data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO products (name, category_id, quantity, unit_price, supplier_id) VALUES (%s, %s, %s, %s, %s)',
-                       (name, category_id, quantity, unit_price, supplier_id))
+        product_id = execute(conn, INSERT_PRODUCT_QUERY, (name, category_id, quantity, unit_price, supplier_id)).lastrowid
+        execute(conn, INSERT_STOCK_OPENING_QUERY, (product_id, quantity))
+        record_change(conn, 'product', product_id, 'insert',
+                      {'name': name, 'category_id': category_id, 'quantity': quantity, 'unit_price': unit_price,
+                       'supplier_id': supplier_id})
         conn.commit()
         conn.close()
         return redirect(url_for('view_products'))
     else:
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('SELECT * FROM categories')
-        categories = cursor.fetchall()
-        cursor.execute('SELECT * FROM suppliers')
-        suppliers = cursor.fetchall()
+        categories = fetch_all(conn, CATEGORIES_QUERY)
+        suppliers = fetch_all(conn, SUPPLIERS_QUERY)
         conn.close()
         return render_template('add_product.html', categories=categories, suppliers=suppliers)
 
 # Edit an existing product
 @app.route('/edit_product/<int:product_id>', methods=['GET', 'POST'])
+@central_catalog
 def edit_product(product_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     if request.method == 'POST':
         name = request.form.get('name')
         category_id = request.form.get('category_id')
@@ -164,23 +391,30 @@ def edit_product(product_id):
         supplier_id = request.form.get('supplier_id')
 
         if not name or not category_id or not quantity or not unit_price or not supplier_id:
+            conn.close()
+            return jsonify({'error': 'Invalid product data'}), 400
+        try:
+            quantity = int(quantity)
+        except ValueError:
+            conn.close()
             return jsonify({'error': 'Invalid product data'}), 400
 
-        cursor.execute('''
-            UPDATE products
-            SET name = %s, category_id = %s, quantity = %s, unit_price = %s, supplier_id = %s
-            WHERE id = %s
-        ''', (name, category_id, quantity, unit_price, supplier_id, product_id))
+        dialect.begin_write(conn)
+        current = fetch_one(conn, PRODUCT_QUANTITY_QUERY, (product_id,))
+        execute(conn, UPDATE_PRODUCT_QUERY, (name, category_id, quantity, unit_price, supplier_id, product_id))
+        # Setting the quantity by hand moves the opening balance with it
+        if current is not None:
+            execute(conn, ADJUST_STOCK_OPENING_QUERY, (quantity - current.quantity, product_id))
+        record_change(conn, 'product', product_id, 'update',
+                      {'name': name, 'category_id': category_id, 'quantity': quantity, 'unit_price': unit_price,
+                       'supplier_id': supplier_id})
         conn.commit()
         conn.close()
         return redirect(url_for('view_products'))
     else:
-        cursor.execute('SELECT * FROM products WHERE id = %s', (product_id,))
-        product = cursor.fetchone()
-        cursor.execute('SELECT * FROM categories')
-        categories = cursor.fetchall()
-        cursor.execute('SELECT * FROM suppliers')
-        suppliers = cursor.fetchall()
+        product = fetch_one(conn, PRODUCT_QUERY, (product_id,))
+        categories = fetch_all(conn, CATEGORIES_QUERY)
+        suppliers = fetch_all(conn, SUPPLIERS_QUERY)
         conn.close()
         if product is None:
             return jsonify({'error': 'Product not found'}), 404
@@ -188,28 +422,36 @@ def edit_product(product_id):
 
 # Delete a product
 @app.route('/delete_product/<int:product_id>', methods=['POST'])
+@central_catalog
 def delete_product(product_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM products WHERE id = %s', (product_id,))
+    execute(conn, DELETE_PRODUCT_QUERY, (product_id,))
+    execute(conn, DELETE_STOCK_OPENING_QUERY, (product_id,))
+    execute(conn, DELETE_MOVEMENT_SUM_QUERY, (product_id,))
+    record_change(conn, 'product', product_id, 'delete', {})
     conn.commit()
     conn.close()
     return redirect(url_for('view_products'))
 
 # **Categories**
 
+CATEGORIES_QUERY = Query('SELECT id, name FROM categories')
+CATEGORY_QUERY = Query('SELECT id, name FROM categories WHERE id = %s')
+INSERT_CATEGORY_QUERY = Query('INSERT INTO categories (name) VALUES (%s)')
+UPDATE_CATEGORY_QUERY = Query('UPDATE categories SET name = %s WHERE id = %s')
+DELETE_CATEGORY_QUERY = Query('DELETE FROM categories WHERE id = %s')
+
 # View all categories
 @app.route('/categories', methods=['GET'])
 def view_categories():
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT * FROM categories')
-    categories_list = cursor.fetchall()
+    categories_list = fetch_all(conn, CATEGORIES_QUERY)
     conn.close()
     return render_template('categories.html', categories=categories_list)
 
 # Add a new category
 @app.route('/add_category', methods=['GET', 'POST'])
+@central_catalog
 def add_category():
     if request.method == 'POST':
         name = request.form.get('name')
@@ -218,8 +460,7 @@ def add_category():
             return jsonify({'error': 'Invalid category data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO categories (name) VALUES (%s)', (name,))
+        execute(conn, INSERT_CATEGORY_QUERY, (name,))
         conn.commit()
         conn.close()
         return redirect(url_for('view_categories'))
@@ -228,22 +469,22 @@ def add_category():
 
 # Edit an existing category
 @app.route('/edit_category/<int:category_id>', methods=['GET', 'POST'])
+@central_catalog
 def edit_category(category_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     if request.method == 'POST':
         name = request.form.get('name')
 
         if not name:
+            conn.close()
             return jsonify({'error': 'Invalid category data'}), 400
 
-        cursor.execute('UPDATE categories SET name = %s WHERE id = %s', (name, category_id))
+        execute(conn, UPDATE_CATEGORY_QUERY, (name, category_id))
         conn.commit()
         conn.close()
         return redirect(url_for('view_categories'))
     else:
-        cursor.execute('SELECT * FROM categories WHERE id = %s', (category_id,))
-        category = cursor.fetchone()
+        category = fetch_one(conn, CATEGORY_QUERY, (category_id,))
         conn.close()
         if category is None:
             return jsonify({'error': 'Category not found'}), 404
@@ -251,28 +492,33 @@ def edit_category(category_id):
 
 # Delete a category
 @app.route('/delete_category/<int:category_id>', methods=['POST'])
+@central_catalog
 def delete_category(category_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM categories WHERE id = %s', (category_id,))
+    execute(conn, DELETE_CATEGORY_QUERY, (category_id,))
     conn.commit()
     conn.close()
     return redirect(url_for('view_categories'))
 
 # **Suppliers**
 
+SUPPLIERS_QUERY = Query('SELECT id, name, contact_info FROM suppliers')
+SUPPLIER_QUERY = Query('SELECT id, name, contact_info FROM suppliers WHERE id = %s')
+INSERT_SUPPLIER_QUERY = Query('INSERT INTO suppliers (name, contact_info) VALUES (%s, %s)')
+UPDATE_SUPPLIER_QUERY = Query('UPDATE suppliers SET name = %s, contact_info = %s WHERE id = %s')
+DELETE_SUPPLIER_QUERY = Query('DELETE FROM suppliers WHERE id = %s')
+
 # View all suppliers
 @app.route('/suppliers', methods=['GET'])
 def view_suppliers():
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT * FROM suppliers')
-    suppliers_list = cursor.fetchall()
+    suppliers_list = fetch_all(conn, SUPPLIERS_QUERY)
     conn.close()
     return render_template('suppliers.html', suppliers=suppliers_list)
 
 # Add a new supplier
 @app.route('/add_supplier', methods=['GET', 'POST'])
+@central_catalog
 def add_supplier():
     if request.method == 'POST':
         name = request.form.get('name')
@@ -282,8 +528,7 @@ def add_supplier():
             return jsonify({'error': 'Invalid supplier data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO suppliers (name, contact_info) VALUES (%s, %s)', (name, contact_info))
+        execute(conn, INSERT_SUPPLIER_QUERY, (name, contact_info))
         conn.commit()
         conn.close()
         return redirect(url_for('view_suppliers'))
@@ -292,23 +537,23 @@ def add_supplier():
 
 # Edit an existing supplier
 @app.route('/edit_supplier/<int:supplier_id>', methods=['GET', 'POST'])
+@central_catalog
 def edit_supplier(supplier_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     if request.method == 'POST':
         name = request.form.get('name')
         contact_info = request.form.get('contact_info')
 
         if not name or not contact_info:
+            conn.close()
             return jsonify({'error': 'Invalid supplier data'}), 400
 
-        cursor.execute('UPDATE suppliers SET name = %s, contact_info = %s WHERE id = %s', (name, contact_info, supplier_id))
+        execute(conn, UPDATE_SUPPLIER_QUERY, (name, contact_info, supplier_id))
         conn.commit()
         conn.close()
         return redirect(url_for('view_suppliers'))
     else:
-        cursor.execute('SELECT * FROM suppliers WHERE id = %s', (supplier_id,))
-        supplier = cursor.fetchone()
+        supplier = fetch_one(conn, SUPPLIER_QUERY, (supplier_id,))
         conn.close()
         if supplier is None:
             return jsonify({'error': 'Supplier not found'}), 404
@@ -316,23 +561,27 @@ def edit_supplier(supplier_id):
 
 # Delete a supplier
 @app.route('/delete_supplier/<int:supplier_id>', methods=['POST'])
+@central_catalog
 def delete_supplier(supplier_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM suppliers WHERE id = %s', (supplier_id,))
+    execute(conn, DELETE_SUPPLIER_QUERY, (supplier_id,))
     conn.commit()
     conn.close()
     return redirect(url_for('view_suppliers'))
 
 # **Warehouses**
 
+WAREHOUSES_QUERY = Query('SELECT id, name FROM warehouses')
+WAREHOUSE_QUERY = Query('SELECT id, name FROM warehouses WHERE id = %s')
+INSERT_WAREHOUSE_QUERY = Query('INSERT INTO warehouses (name) VALUES (%s)')
+UPDATE_WAREHOUSE_QUERY = Query('UPDATE warehouses SET name = %s WHERE id = %s')
+DELETE_WAREHOUSE_QUERY = Query('DELETE FROM warehouses WHERE id = %s')
+
 # View all warehouses
 @app.route('/warehouses', methods=['GET'])
 def view_warehouses():
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT * FROM warehouses')
-    warehouses_list = cursor.fetchall()
+    warehouses_list = fetch_all(conn, WAREHOUSES_QUERY)
     conn.close()
     return render_template('warehouses.html', warehouses=warehouses_list)
 
@@ -346,8 +595,7 @@ def add_warehouse():
             return jsonify({'error': 'Invalid warehouse data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO warehouses (name) VALUES (%s)', (name,))
+        execute(conn, INSERT_WAREHOUSE_QUERY, (name,))
         conn.commit()
         conn.close()
         return redirect(url_for('view_warehouses'))
@@ -358,20 +606,19 @@ def add_warehouse():
 @app.route('/edit_warehouse/<int:warehouse_id>', methods=['GET', 'POST'])
 def edit_warehouse(warehouse_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     if request.method == 'POST':
         name = request.form.get('name')
 
         if not name:
+            conn.close()
             return jsonify({'error': 'Invalid warehouse data'}), 400
 
-        cursor.execute('UPDATE warehouses SET name = %s WHERE id = %s', (name, warehouse_id))
+        execute(conn, UPDATE_WAREHOUSE_QUERY, (name, warehouse_id))
         conn.commit()
         conn.close()
         return redirect(url_for('view_warehouses'))
     else:
-        cursor.execute('SELECT * FROM warehouses WHERE id = %s', (warehouse_id,))
-        warehouse = cursor.fetchone()
+        warehouse = fetch_one(conn, WAREHOUSE_QUERY, (warehouse_id,))
         conn.close()
         if warehouse is None:
             return jsonify({'error': 'Warehouse not found'}), 404
@@ -381,27 +628,43 @@ def edit_warehouse(warehouse_id):
 @app.route('/delete_warehouse/<int:warehouse_id>', methods=['POST'])
 def delete_warehouse(warehouse_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM warehouses WHERE id = %s', (warehouse_id,))
+    execute(conn, DELETE_WAREHOUSE_QUERY, (warehouse_id,))
     conn.commit()
     conn.close()
     return redirect(url_for('view_warehouses'))
 
 # **Transactions**
 
+TRANSACTIONS_QUERY = Query('''
+    SELECT transactions.id, products.name AS product, transactions.transaction_type, transactions.quantity, transactions.date
+    FROM transactions
+    LEFT JOIN products ON transactions.product_id = products.id
+    ORDER BY transactions.id DESC
+    LIMIT %s OFFSET %s
+''')
+TRANSACTION_QUERY = Query('SELECT id, product_id, transaction_type, quantity, date FROM transactions WHERE id = %s')
+# The old values of a transaction that is about to change
+LOCK_TRANSACTION_QUERY = Query(f'''
+    SELECT id, product_id, transaction_type, quantity, date FROM transactions WHERE id = %s{dialect.for_update}
+''')
+INSERT_TRANSACTION_QUERY = Query('INSERT INTO transactions (product_id, transaction_type, quantity) VALUES (%s, %s, %s)')
+UPDATE_TRANSACTION_QUERY = Query('''
+    UPDATE transactions
+    SET product_id = %s, transaction_type = %s, quantity = %s
+    WHERE id = %s
+''')
+DELETE_TRANSACTION_QUERY = Query('DELETE FROM transactions WHERE id = %s')
+
 # View all transactions
 @app.route('/transactions', methods=['GET'])
+@admission_control('list', cost=page_cost)
 def view_transactions():
+    page, per_page = get_page_args()
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('''
-        SELECT transactions.id, products.name AS product, transactions.transaction_type, transactions.quantity, transactions.date
-        FROM transactions
-        LEFT JOIN products ON transactions.product_id = products.id
-    ''')
-    transactions_list = cursor.fetchall()
+    transactions_list, has_next = fetch_page(conn, TRANSACTIONS_QUERY, page, per_page)
     conn.close()
-    return render_template('transactions.html', transactions=transactions_list)
+    return render_template('transactions.html', transactions=transactions_list, page=page, per_page=per_page,
+                           has_next=has_next)
 
 # Add a new transaction
 @app.route('/add_transaction', methods=['GET', 'POST'])
@@ -415,21 +678,20 @@ def add_transaction():
             return jsonify({'error': 'Invalid transaction data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO transactions (product_id, transaction_type, quantity) VALUES (%s, %s, %s)',
-                       (product_id, transaction_type, quantity))
+        transaction_id = execute(conn, INSERT_TRANSACTION_QUERY, (product_id, transaction_type, quantity)).lastrowid
         if transaction_type == 'in':
-            cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (quantity, product_id))
+            execute(conn, ADD_STOCK_QUERY, (quantity, product_id))
         elif transaction_type == 'out':
-            cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (quantity, product_id))
+            execute(conn, REMOVE_STOCK_QUERY, (quantity, product_id))
+        record_change(conn, 'transaction', transaction_id, 'insert',
+                      {'product_id': product_id, 'transaction_type': transaction_type, 'quantity': quantity})
+        record_stock_changes(conn, [product_id])
         conn.commit()
         conn.close()
         return redirect(url_for('view_transactions'))
     else:
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('SELECT * FROM products')
-        products = cursor.fetchall()
+        products = fetch_all(conn, PRODUCT_OPTIONS_QUERY)
         conn.close()
         return render_template('add_transaction.html', products=products)
 
@@ -437,7 +699,6 @@ def add_transaction():
 @app.route('/edit_transaction/<int:transaction_id>', methods=['GET', 'POST'])
 def edit_transaction(transaction_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
 
     if request.method == 'POST':
         product_id = request.form.get('product_id')
@@ -445,42 +706,44 @@ def edit_transaction(transaction_id):
         quantity = int(request.form.get('quantity'))
 
         if not product_id or not transaction_type or not quantity:
+            conn.close()
             return jsonify({'error': 'Invalid transaction data'}), 400
 
         # Retrieve the old transaction
-        cursor.execute('SELECT * FROM transactions WHERE id = %s', (transaction_id,))
-        old_transaction = cursor.fetchone()
-        old_quantity = old_transaction['quantity']
-        old_product_id = old_transaction['product_id']
-        old_transaction_type = old_transaction['transaction_type']
+        dialect.begin_write(conn)
+        old_transaction = fetch_one(conn, LOCK_TRANSACTION_QUERY, (transaction_id,))
+        if old_transaction is None:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Transaction not found'}), 404
+        old_quantity = old_transaction.quantity
+        old_product_id = old_transaction.product_id
+        old_transaction_type = old_transaction.transaction_type
 
         # Revert the product quantity based on the old transaction
         if old_transaction_type == 'in':
-            cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (old_quantity, old_product_id))
+            execute(conn, REMOVE_STOCK_QUERY, (old_quantity, old_product_id))
         elif old_transaction_type == 'out':
-            cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (old_quantity, old_product_id))
+            execute(conn, ADD_STOCK_QUERY, (old_quantity, old_product_id))
 
         # Apply the new transaction quantity
         if transaction_type == 'in':
-            cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (quantity, product_id))
+            execute(conn, ADD_STOCK_QUERY, (quantity, product_id))
         elif transaction_type == 'out':
-            cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (quantity, product_id))
+            execute(conn, REMOVE_STOCK_QUERY, (quantity, product_id))
 
         # Update the transaction
-        cursor.execute('''
-            UPDATE transactions
-            SET product_id = %s, transaction_type = %s, quantity = %s
-            WHERE id = %s
-        ''', (product_id, transaction_type, quantity, transaction_id))
+        execute(conn, UPDATE_TRANSACTION_QUERY, (product_id, transaction_type, quantity, transaction_id))
 
+        record_change(conn, 'transaction', transaction_id, 'update',
+                      {'product_id': product_id, 'transaction_type': transaction_type, 'quantity': quantity})
+        record_stock_changes(conn, [old_product_id, product_id])
         conn.commit()
         conn.close()
         return redirect(url_for('view_transactions'))
     else:
-        cursor.execute('SELECT * FROM transactions WHERE id = %s', (transaction_id,))
-        transaction = cursor.fetchone()
-        cursor.execute('SELECT * FROM products')
-        products = cursor.fetchall()
+        transaction = fetch_one(conn, TRANSACTION_QUERY, (transaction_id,))
+        products = fetch_all(conn, PRODUCT_OPTIONS_QUERY)
         conn.close()
         if transaction is None:
             return jsonify({'error': 'Transaction not found'}), 404
@@ -490,43 +753,68 @@ def edit_transaction(transaction_id):
 @app.route('/delete_transaction/<int:transaction_id>', methods=['POST'])
 def delete_transaction(transaction_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
     # Retrieve the transaction to adjust product quantity
-    cursor.execute('SELECT * FROM transactions WHERE id = %s', (transaction_id,))
-    transaction = cursor.fetchone()
+    dialect.begin_write(conn)
+    transaction = fetch_one(conn, LOCK_TRANSACTION_QUERY, (transaction_id,))
     if transaction is not None:
-        product_id = transaction['product_id']
-        transaction_type = transaction['transaction_type']
-        quantity = transaction['quantity']
+        product_id = transaction.product_id
+        transaction_type = transaction.transaction_type
+        quantity = transaction.quantity
         # Revert the product quantity
         if transaction_type == 'in':
-            cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (quantity, product_id))
+            execute(conn, REMOVE_STOCK_QUERY, (quantity, product_id))
         elif transaction_type == 'out':
-            cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (quantity, product_id))
+            execute(conn, ADD_STOCK_QUERY, (quantity, product_id))
+        record_change(conn, 'transaction', transaction_id, 'delete', {})
+        record_stock_changes(conn, [product_id])
     # Delete the transaction
-    cursor.execute('DELETE FROM transactions WHERE id = %s', (transaction_id,))
+    execute(conn, DELETE_TRANSACTION_QUERY, (transaction_id,))
     conn.commit()
     conn.close()
     return redirect(url_for('view_transactions'))
 
 # **Sales Orders**
 
+SALES_ORDERS_QUERY = Query('''
+    SELECT so.id, c.name AS customer_name, so.order_date, so.status, so.total_amount
+    FROM sales_orders so
+    JOIN customers c ON so.customer_id = c.id
+    ORDER BY so.id DESC
+    LIMIT %s OFFSET %s
+''')
+SALES_ORDER_QUERY = Query('''
+    SELECT so.id, so.customer_id, so.order_date, so.status, so.total_amount, c.name AS customer_name
+    FROM sales_orders so
+    JOIN customers c ON so.customer_id = c.id
+    WHERE so.id = %s
+''')
+SALES_ORDER_ITEMS_QUERY = Query('''
+    SELECT soi.id, soi.sales_order_id, soi.product_id, soi.quantity, soi.unit_price, soi.total_price, p.name AS product_name
+    FROM sales_order_items soi
+    JOIN products p ON soi.product_id = p.id
+    WHERE soi.sales_order_id = %s
+''')
+INSERT_SALES_ORDER_QUERY = Query('INSERT INTO sales_orders (customer_id) VALUES (%s)')
+INSERT_SALES_ORDER_ITEM_QUERY = Query('''
+    INSERT INTO sales_order_items (sales_order_id, product_id, quantity, unit_price, total_price)
+    VALUES (%s, %s, %s, %s, %s)
+''')
+UPDATE_SALES_ORDER_TOTAL_QUERY = Query('UPDATE sales_orders SET total_amount = %s WHERE id = %s')
+
 # View all sales orders
 @app.route('/sales_orders', methods=['GET'])
+@admission_control('list', cost=page_cost)
 def view_sales_orders():
+    page, per_page = get_page_args()
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('''
-        SELECT so.id, c.name AS customer_name, so.order_date, so.status, so.total_amount
-        FROM sales_orders so
-        JOIN customers c ON so.customer_id = c.id
-    ''')
-    sales_orders = cursor.fetchall()
+    sales_orders, has_next = fetch_page(conn, SALES_ORDERS_QUERY, page, per_page)
     conn.close()
-    return render_template('sales_orders.html', sales_orders=sales_orders)
+    return render_template('sales_orders.html', sales_orders=sales_orders, page=page, per_page=per_page,
+                           has_next=has_next)
 
 # Add a new sales order
 @app.route('/add_sales_order', methods=['GET', 'POST'])
+@admission_control('order_write', cost=order_cost)
 def add_sales_order():
     if request.method == 'POST':
         customer_id = request.form.get('customer_id')
@@ -537,43 +825,39 @@ def add_sales_order():
             return jsonify({'error': 'Invalid sales order data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
 
         # Create a new sales order
-        cursor.execute('INSERT INTO sales_orders (customer_id) VALUES (%s)', (customer_id,))
-        sales_order_id = cursor.lastrowid
+        sales_order_id = execute(conn, INSERT_SALES_ORDER_QUERY, (customer_id,)).lastrowid
 
         total_amount = 0
 
         # Add order items
         for product_id, quantity in zip(product_ids, quantities):
-            cursor.execute('SELECT unit_price FROM products WHERE id = %s', (product_id,))
-            unit_price = cursor.fetchone()[0]
+            unit_price = fetch_one(conn, UNIT_PRICE_QUERY, (product_id,)).unit_price
             quantity = int(quantity)
             total_price = unit_price * quantity
             total_amount += total_price
 
-            cursor.execute('''
-                INSERT INTO sales_order_items (sales_order_id, product_id, quantity, unit_price, total_price)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (sales_order_id, product_id, quantity, unit_price, total_price))
+            execute(conn, INSERT_SALES_ORDER_ITEM_QUERY, (sales_order_id, product_id, quantity, unit_price, total_price))
 
             # Update product quantity
-            cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (quantity, product_id))
+            execute(conn, REMOVE_STOCK_QUERY, (quantity, product_id))
 
         # Update the total amount of the sales order
-        cursor.execute('UPDATE sales_orders SET total_amount = %s WHERE id = %s', (total_amount, sales_order_id))
+        execute(conn, UPDATE_SALES_ORDER_TOTAL_QUERY, (total_amount, sales_order_id))
 
+        record_change(conn, 'sales_order', sales_order_id, 'insert',
+                      {'customer_id': customer_id, 'total_amount': total_amount,
+                       'items': [{'product_id': product_id, 'quantity': int(quantity)}
+                                 for product_id, quantity in zip(product_ids, quantities)]})
+        record_stock_changes(conn, product_ids)
         conn.commit()
         conn.close()
         return redirect(url_for('view_sales_orders'))
     else:
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('SELECT * FROM customers')
-        customers = cursor.fetchall()
-        cursor.execute('SELECT * FROM products')
-        products = cursor.fetchall()
+        customers = fetch_all(conn, CUSTOMERS_QUERY)
+        products = fetch_all(conn, PRODUCT_OPTIONS_QUERY)
         conn.close()
         return render_template('add_sales_order.html', customers=customers, products=products)
 
@@ -581,32 +865,31 @@ def add_sales_order():
 @app.route('/edit_sales_order/<int:sales_order_id>', methods=['GET', 'POST'])
 def edit_sales_order(sales_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
 
     if request.method == 'POST':
         status = request.form.get('status')
-        cursor.execute('UPDATE sales_orders SET status = %s WHERE id = %s', (status, sales_order_id))
+        if status not in ORDER_KINDS['sales']['transitions']:
+            conn.close()
+            return jsonify({'error': 'Invalid order status'}), 400
+
+        _, skipped, missing = change_order_status(conn, 'sales', [sales_order_id], status)
+        if missing:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Order not found'}), 404
+        if skipped:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': f'Order cannot be moved to {status}'}), 409
         conn.commit()
         conn.close()
         return redirect(url_for('view_sales_orders'))
     else:
         # Retrieve sales order details
-        cursor.execute('''
-            SELECT so.*, c.name AS customer_name
-            FROM sales_orders so
-            JOIN customers c ON so.customer_id = c.id
-            WHERE so.id = %s
-        ''', (sales_order_id,))
-        sales_order = cursor.fetchone()
+        sales_order = fetch_one(conn, SALES_ORDER_QUERY, (sales_order_id,))
 
         # Retrieve order items
-        cursor.execute('''
-            SELECT soi.*, p.name AS product_name
-            FROM sales_order_items soi
-            JOIN products p ON soi.product_id = p.id
-            WHERE soi.sales_order_id = %s
-        ''', (sales_order_id,))
-        order_items = cursor.fetchall()
+        order_items = fetch_all(conn, SALES_ORDER_ITEMS_QUERY, (sales_order_id,))
 
         conn.close()
         return render_template('edit_sales_order.html', sales_order=sales_order, order_items=order_items)
@@ -615,19 +898,8 @@ def edit_sales_order(sales_order_id):
 @app.route('/delete_sales_order/<int:sales_order_id>', methods=['POST'])
 def delete_sales_order(sales_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Revert product quantities
-    cursor.execute('SELECT product_id, quantity FROM sales_order_items WHERE sales_order_id = %s', (sales_order_id,))
-    items = cursor.fetchall()
-    for item in items:
-        cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (item[1], item[0]))
-
-    # Delete order items
-    cursor.execute('DELETE FROM sales_order_items WHERE sales_order_id = %s', (sales_order_id,))
-    # Delete the sales order
-    cursor.execute('DELETE FROM sales_orders WHERE id = %s', (sales_order_id,))
-
+    # Revert product quantities and delete the order with its items
+    delete_orders(conn, 'sales', [sales_order_id])
     conn.commit()
     conn.close()
     return redirect(url_for('view_sales_orders'))
@@ -636,16 +908,9 @@ def delete_sales_order(sales_order_id):
 @app.route('/sales_order/<int:sales_order_id>', methods=['GET'])
 def view_sales_order(sales_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
 
     # Retrieve sales order details
-    cursor.execute('''
-        SELECT so.*, c.name AS customer_name
-        FROM sales_orders so
-        JOIN customers c ON so.customer_id = c.id
-        WHERE so.id = %s
-    ''', (sales_order_id,))
-    sales_order = cursor.fetchone()
+    sales_order = fetch_one(conn, SALES_ORDER_QUERY, (sales_order_id,))
 
     # Check if the order exists
     if not sales_order:
@@ -653,35 +918,53 @@ def view_sales_order(sales_order_id):
         return "Order not found", 404
 
     # Retrieve order items
-    cursor.execute('''
-        SELECT soi.*, p.name AS product_name
-        FROM sales_order_items soi
-        JOIN products p ON soi.product_id = p.id
-        WHERE soi.sales_order_id = %s
-    ''', (sales_order_id,))
-    order_items = cursor.fetchall()
+    order_items = fetch_all(conn, SALES_ORDER_ITEMS_QUERY, (sales_order_id,))
 
     conn.close()
     return render_template('view_sales_order.html', sales_order=sales_order, order_items=order_items)
 
 # **Purchase Orders**
 
+PURCHASE_ORDERS_QUERY = Query('''
+    SELECT po.id, s.name AS supplier_name, po.order_date, po.status, po.total_amount
+    FROM purchase_orders po
+    JOIN suppliers s ON po.supplier_id = s.id
+    ORDER BY po.id DESC
+    LIMIT %s OFFSET %s
+''')
+PURCHASE_ORDER_QUERY = Query('''
+    SELECT po.id, po.supplier_id, po.order_date, po.status, po.total_amount, s.name AS supplier_name
+    FROM purchase_orders po
+    JOIN suppliers s ON po.supplier_id = s.id
+    WHERE po.id = %s
+''')
+PURCHASE_ORDER_ITEMS_QUERY = Query('''
+    SELECT poi.id, poi.purchase_order_id, poi.product_id, poi.quantity, poi.unit_price, poi.total_price, p.name AS product_name
+    FROM purchase_order_items poi
+    JOIN products p ON poi.product_id = p.id
+    WHERE poi.purchase_order_id = %s
+''')
+INSERT_PURCHASE_ORDER_QUERY = Query('INSERT INTO purchase_orders (supplier_id) VALUES (%s)')
+INSERT_PURCHASE_ORDER_ITEM_QUERY = Query('''
+    INSERT INTO purchase_order_items (purchase_order_id, product_id, quantity, unit_price, total_price)
+    VALUES (%s, %s, %s, %s, %s)
+''')
+UPDATE_PURCHASE_ORDER_TOTAL_QUERY = Query('UPDATE purchase_orders SET total_amount = %s WHERE id = %s')
+
 # View all purchase orders
 @app.route('/purchase_orders', methods=['GET'])
+@admission_control('list', cost=page_cost)
 def view_purchase_orders():
+    page, per_page = get_page_args()
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('''
-        SELECT po.id, s.name AS supplier_name, po.order_date, po.status, po.total_amount
-        FROM purchase_orders po
-        JOIN suppliers s ON po.supplier_id = s.id
-    ''')
-    purchase_orders = cursor.fetchall()
+    purchase_orders, has_next = fetch_page(conn, PURCHASE_ORDERS_QUERY, page, per_page)
     conn.close()
-    return render_template('purchase_orders.html', purchase_orders=purchase_orders)
+    return render_template('purchase_orders.html', purchase_orders=purchase_orders, page=page, per_page=per_page,
+                           has_next=has_next)
 
 # Add a new purchase order
 @app.route('/add_purchase_order', methods=['GET', 'POST'])
+@admission_control('order_write', cost=order_cost)
 def add_purchase_order():
     if request.method == 'POST':
         supplier_id = request.form.get('supplier_id')
@@ -692,43 +975,39 @@ def add_purchase_order():
             return jsonify({'error': 'Invalid purchase order data'}), 400
 
         conn = get_db_connection()
-        cursor = conn.cursor()
 
         # Create a new purchase order
-        cursor.execute('INSERT INTO purchase_orders (supplier_id) VALUES (%s)', (supplier_id,))
-        purchase_order_id = cursor.lastrowid
+        purchase_order_id = execute(conn, INSERT_PURCHASE_ORDER_QUERY, (supplier_id,)).lastrowid
 
         total_amount = 0
 
         # Add order items
         for product_id, quantity in zip(product_ids, quantities):
-            cursor.execute('SELECT unit_price FROM products WHERE id = %s', (product_id,))
-            unit_price = cursor.fetchone()[0]
+            unit_price = fetch_one(conn, UNIT_PRICE_QUERY, (product_id,)).unit_price
             quantity = int(quantity)
             total_price = unit_price * quantity
             total_amount += total_price
 
-            cursor.execute('''
-                INSERT INTO purchase_order_items (purchase_order_id, product_id, quantity, unit_price, total_price)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (purchase_order_id, product_id, quantity, unit_price, total_price))
+            execute(conn, INSERT_PURCHASE_ORDER_ITEM_QUERY, (purchase_order_id, product_id, quantity, unit_price, total_price))
 
             # Update product quantity
-            cursor.execute('UPDATE products SET quantity = quantity + %s WHERE id = %s', (quantity, product_id))
+            execute(conn, ADD_STOCK_QUERY, (quantity, product_id))
 
         # Update the total amount of the purchase order
-        cursor.execute('UPDATE purchase_orders SET total_amount = %s WHERE id = %s', (total_amount, purchase_order_id))
+        execute(conn, UPDATE_PURCHASE_ORDER_TOTAL_QUERY, (total_amount, purchase_order_id))
 
+        record_change(conn, 'purchase_order', purchase_order_id, 'insert',
+                      {'supplier_id': supplier_id, 'total_amount': total_amount,
+                       'items': [{'product_id': product_id, 'quantity': int(quantity)}
+                                 for product_id, quantity in zip(product_ids, quantities)]})
+        record_stock_changes(conn, product_ids)
         conn.commit()
         conn.close()
         return redirect(url_for('view_purchase_orders'))
     else:
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('SELECT * FROM suppliers')
-        suppliers = cursor.fetchall()
-        cursor.execute('SELECT * FROM products')
-        products = cursor.fetchall()
+        suppliers = fetch_all(conn, SUPPLIERS_QUERY)
+        products = fetch_all(conn, PRODUCT_OPTIONS_QUERY)
         conn.close()
         return render_template('add_purchase_order.html', suppliers=suppliers, products=products)
 
@@ -736,32 +1015,31 @@ def add_purchase_order():
 @app.route('/edit_purchase_order/<int:purchase_order_id>', methods=['GET', 'POST'])
 def edit_purchase_order(purchase_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
 
     if request.method == 'POST':
         status = request.form.get('status')
-        cursor.execute('UPDATE purchase_orders SET status = %s WHERE id = %s', (status, purchase_order_id))
+        if status not in ORDER_KINDS['purchase']['transitions']:
+            conn.close()
+            return jsonify({'error': 'Invalid order status'}), 400
+
+        _, skipped, missing = change_order_status(conn, 'purchase', [purchase_order_id], status)
+        if missing:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Order not found'}), 404
+        if skipped:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': f'Order cannot be moved to {status}'}), 409
         conn.commit()
         conn.close()
         return redirect(url_for('view_purchase_orders'))
     else:
         # Retrieve purchase order details
-        cursor.execute('''
-            SELECT po.*, s.name AS supplier_name
-            FROM purchase_orders po
-            JOIN suppliers s ON po.supplier_id = s.id
-            WHERE po.id = %s
-        ''', (purchase_order_id,))
-        purchase_order = cursor.fetchone()
+        purchase_order = fetch_one(conn, PURCHASE_ORDER_QUERY, (purchase_order_id,))
 
         # Retrieve order items
-        cursor.execute('''
-            SELECT poi.*, p.name AS product_name
-            FROM purchase_order_items poi
-            JOIN products p ON poi.product_id = p.id
-            WHERE poi.purchase_order_id = %s
-        ''', (purchase_order_id,))
-        order_items = cursor.fetchall()
+        order_items = fetch_all(conn, PURCHASE_ORDER_ITEMS_QUERY, (purchase_order_id,))
 
         conn.close()
         return render_template('edit_purchase_order.html', purchase_order=purchase_order, order_items=order_items)
@@ -770,19 +1048,8 @@ def edit_purchase_order(purchase_order_id):
 @app.route('/delete_purchase_order/<int:purchase_order_id>', methods=['POST'])
 def delete_purchase_order(purchase_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Revert product quantities
-    cursor.execute('SELECT product_id, quantity FROM purchase_order_items WHERE purchase_order_id = %s', (purchase_order_id,))
-    items = cursor.fetchall()
-    for item in items:
-        cursor.execute('UPDATE products SET quantity = quantity - %s WHERE id = %s', (item[1], item[0]))
-
-    # Delete order items
-    cursor.execute('DELETE FROM purchase_order_items WHERE purchase_order_id = %s', (purchase_order_id,))
-    # Delete the purchase order
-    cursor.execute('DELETE FROM purchase_orders WHERE id = %s', (purchase_order_id,))
-
+    # Revert product quantities and delete the order with its items
+    delete_orders(conn, 'purchase', [purchase_order_id])
     conn.commit()
     conn.close()
     return redirect(url_for('view_purchase_orders'))
@@ -791,16 +1058,9 @@ def delete_purchase_order(purchase_order_id):
 @app.route('/purchase_order/<int:purchase_order_id>', methods=['GET'])
 def view_purchase_order(purchase_order_id):
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
 
     # Retrieve purchase order details
-    cursor.execute('''
-        SELECT po.*, s.name AS supplier_name
-        FROM purchase_orders po
-        JOIN suppliers s ON po.supplier_id = s.id
-        WHERE po.id = %s
-    ''', (purchase_order_id,))
-    purchase_order = cursor.fetchone()
+    purchase_order = fetch_one(conn, PURCHASE_ORDER_QUERY, (purchase_order_id,))
 
     # Check if the order exists
     if not purchase_order:
@@ -808,16 +1068,1280 @@ def view_purchase_order(purchase_order_id):
         return "Order not found", 404
 
     # Retrieve order items
-    cursor.execute('''
-        SELECT poi.*, p.name AS product_name
-        FROM purchase_order_items poi
-        JOIN products p ON poi.product_id = p.id
-        WHERE poi.purchase_order_id = %s
-    ''', (purchase_order_id,))
-    order_items = cursor.fetchall()
+    order_items = fetch_all(conn, PURCHASE_ORDER_ITEMS_QUERY, (purchase_order_id,))
 
     conn.close()
     return render_template('view_purchase_order.html', purchase_order=purchase_order, order_items=order_items)
 
+# **Order batches**
+
+# Allowed status changes. Cancelling an order returns its stock; an order
+# that is already in the target status is left alone. The schema does not
+# define the status values and the edit forms used to accept any text, so
+# an order whose current status is not listed here may move to any listed
+# status instead of being stuck.
+#
+# Orders cancelled through those forms kept their stock, so the status does
+# not tell whether an order still holds stock: stock_returned does. It is
+# only set when change_order_status returns the stock.
+ORDER_KINDS = {
+    'sales': {
+        'table': 'sales_orders',
+        'items': 'sales_order_items',
+        'order_key': 'sales_order_id',
+        'party_key': 'customer_id',
+        # Sign applied to products.quantity when the order's stock is reverted
+        'revert_sign': '+',
+        'transitions': {
+            'pending': {'processing', 'shipped', 'cancelled'},
+            'processing': {'shipped', 'cancelled'},
+            'shipped': {'delivered'},
+            'delivered': set(),
+            'cancelled': set(),
+        },
+    },
+    'purchase': {
+        'table': 'purchase_orders',
+        'items': 'purchase_order_items',
+        'order_key': 'purchase_order_id',
+        'party_key': 'supplier_id',
+        'revert_sign': '-',
+        'transitions': {
+            'pending': {'ordered', 'received', 'cancelled'},
+            'ordered': {'received', 'cancelled'},
+            'received': set(),
+            'cancelled': set(),
+        },
+    },
+}
+
+# Orders handled per statement
+BATCH_CHUNK_SIZE = 500
+# Orders in a batch request covered by one token
+ORDERS_PER_TOKEN = 50
+
+def batch_cost():
+    return 1 + len(request.form.getlist('order_id[]')) // ORDERS_PER_TOKEN
+
+def get_order_ids():
+    order_ids = [int(order_id) for order_id in request.form.getlist('order_id[]')]
+    return list(dict.fromkeys(order_ids))
+
+def chunked(values, size=BATCH_CHUNK_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def placeholders_for(values):
+    return ', '.join(['%s'] * len(values))
+
+# Lock the orders and return their current (status, stock_returned) by id
+def lock_orders(conn, kind, order_ids):
+    dialect.begin_write(conn)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, status, stock_returned FROM {ORDER_KINDS[kind]['table']} "
+                   f"WHERE id IN ({placeholders_for(order_ids)}){dialect.for_update}", order_ids)
+    return {order_id: (status, stock_returned) for order_id, status, stock_returned in cursor.fetchall()}
+
+# Put the stock of the orders back with one UPDATE joined to the aggregated
+# order items; returns the affected product ids
+def revert_order_stock(conn, kind, order_ids):
+    order_kind = ORDER_KINDS[kind]
+    placeholders = placeholders_for(order_ids)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT DISTINCT product_id FROM {order_kind['items']} WHERE {order_kind['order_key']} IN ({placeholders})",
+                   order_ids)
+    product_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute(dialect.update_from(
+        'products', 'quantity', f"products.quantity {order_kind['revert_sign']} reverted.quantity",
+        f"SELECT product_id, SUM(quantity) AS quantity FROM {order_kind['items']} "
+        f"WHERE {order_kind['order_key']} IN ({placeholders}) GROUP BY product_id",
+        'reverted', 'products.id = reverted.product_id'), order_ids)
+    return product_ids
+
+# Move orders to a new status; returns the ids that were changed, the ids
+# whose current status does not allow it and the ids that do not exist. The
+# caller commits.
+def change_order_status(conn, kind, order_ids, status):
+    order_kind = ORDER_KINDS[kind]
+    transitions = order_kind['transitions']
+    updated, skipped, missing, product_ids = [], [], [], set()
+    cursor = conn.cursor()
+    for chunk in chunked(order_ids):
+        statuses = lock_orders(conn, kind, chunk)
+        eligible = []
+        for order_id in chunk:
+            if order_id not in statuses:
+                missing.append(order_id)
+                continue
+            current, _ = statuses[order_id]
+            if current == status:
+                continue
+            # Statuses outside the map may move to any status in it
+            if status in transitions.get(current, transitions.keys()):
+                eligible.append(order_id)
+            else:
+                skipped.append(order_id)
+        if not eligible:
+            continue
+
+        placeholders = placeholders_for(eligible)
+        cursor.execute(f"UPDATE {order_kind['table']} SET status = %s WHERE id IN ({placeholders})", [status] + eligible)
+        if status == 'cancelled':
+            held = [order_id for order_id in eligible if not statuses[order_id][1]]
+            if held:
+                product_ids.update(revert_order_stock(conn, kind, held))
+                cursor.execute(f"UPDATE {order_kind['table']} SET stock_returned = 1 "
+                               f"WHERE id IN ({placeholders_for(held)})", held)
+        updated.extend(eligible)
+
+    record_changes(conn, f'{kind}_order', 'update', [(order_id, {'status': status}) for order_id in updated])
+    record_stock_changes(conn, product_ids)
+    return updated, skipped, missing
+
+# Delete orders with their items, reverting the stock of orders that still
+# hold it; returns the ids that existed. The caller commits.
+def delete_orders(conn, kind, order_ids):
+    order_kind = ORDER_KINDS[kind]
+    deleted, product_ids = [], set()
+    cursor = conn.cursor()
+    for chunk in chunked(order_ids):
+        statuses = lock_orders(conn, kind, chunk)
+        existing = [order_id for order_id in chunk if order_id in statuses]
+        if not existing:
+            continue
+
+        held = [order_id for order_id in existing if not statuses[order_id][1]]
+        if held:
+            product_ids.update(revert_order_stock(conn, kind, held))
+        placeholders = placeholders_for(existing)
+        cursor.execute(f"DELETE FROM {order_kind['items']} WHERE {order_kind['order_key']} IN ({placeholders})", existing)
+        cursor.execute(f"DELETE FROM {order_kind['table']} WHERE id IN ({placeholders})", existing)
+        deleted.extend(existing)
+
+    record_changes(conn, f'{kind}_order', 'delete', [(order_id, {}) for order_id in deleted])
+    record_stock_changes(conn, product_ids)
+    return deleted
+
+# Orders created before stock_returned existed start at 0: those cancelled
+# as plain text still hold their stock
+ORDER_STOCK_COLUMN = ('stock_returned', 'BOOLEAN NOT NULL DEFAULT 0')
+
+def add_order_stock_columns(conn, sql_dialect):
+    for order_kind in ORDER_KINDS.values():
+        sql_dialect.add_column(conn, order_kind['table'], *ORDER_STOCK_COLUMN)
+
+# Add stock_returned to the order tables: flask init-order-stock
+@app.cli.command('init-order-stock')
+def init_order_stock_command():
+    conn = get_db_connection()
+    add_order_stock_columns(conn, dialect)
+    conn.commit()
+    conn.close()
+    click.echo('order stock columns ready')
+
+# Change the status of many orders in one transaction
+@app.route('/batch_update_<any(sales, purchase):kind>_orders', methods=['POST'])
+@admission_control('order_write', cost=batch_cost)
+def batch_update_orders(kind):
+    status = request.form.get('status')
+    try:
+        order_ids = get_order_ids()
+    except ValueError:
+        order_ids = None
+    if not order_ids or status not in ORDER_KINDS[kind]['transitions']:
+        return jsonify({'error': 'Invalid batch data'}), 400
+
+    conn = get_db_connection()
+    updated, skipped, missing = change_order_status(conn, kind, order_ids, status)
+    conn.commit()
+    conn.close()
+    return jsonify({'status': status, 'updated': updated, 'skipped': skipped, 'missing': missing})
+
+# Delete many orders in one transaction
+@app.route('/batch_delete_<any(sales, purchase):kind>_orders', methods=['POST'])
+@admission_control('order_write', cost=batch_cost)
+def batch_delete_orders(kind):
+    try:
+        order_ids = get_order_ids()
+    except ValueError:
+        order_ids = None
+    if not order_ids:
+        return jsonify({'error': 'Invalid batch data'}), 400
+
+    conn = get_db_connection()
+    deleted = delete_orders(conn, kind, order_ids)
+    conn.commit()
+    conn.close()
+    return jsonify({'deleted': deleted})
+
+# **Reports**
+
+# Tables copied into the reports store as (table, columns, feed). Tables with
+# a feed are kept up to date from the change_events outbox: `feed` names the
+# entity whose events re-copy the table's rows and the column holding that
+# entity's id. The others are small and copied in full every time.
+SNAPSHOT_TABLES = [
+    ('categories', [('id', 'BIGINT'), ('name', 'VARCHAR')], None),
+    ('suppliers', [('id', 'BIGINT'), ('name', 'VARCHAR')], None),
+    ('products', [('id', 'BIGINT'), ('name', 'VARCHAR'), ('category_id', 'BIGINT'), ('supplier_id', 'BIGINT'),
+                  ('quantity', 'BIGINT'), ('unit_price', 'DECIMAL(18, 2)')], ('product', 'id')),
+    ('sales_orders', [('id', 'BIGINT'), ('customer_id', 'BIGINT'), ('order_date', 'TIMESTAMP'),
+                      ('status', 'VARCHAR'), ('total_amount', 'DECIMAL(18, 2)')], ('sales_order', 'id')),
+    ('purchase_orders', [('id', 'BIGINT'), ('supplier_id', 'BIGINT'), ('order_date', 'TIMESTAMP'),
+                         ('status', 'VARCHAR'), ('total_amount', 'DECIMAL(18, 2)')], ('purchase_order', 'id')),
+    ('transactions', [('id', 'BIGINT'), ('product_id', 'BIGINT'), ('transaction_type', 'VARCHAR'),
+                      ('quantity', 'BIGINT'), ('date', 'TIMESTAMP')], ('transaction', 'id')),
+    ('sales_order_items', [('id', 'BIGINT'), ('sales_order_id', 'BIGINT'), ('product_id', 'BIGINT'),
+                           ('quantity', 'BIGINT'), ('unit_price', 'DECIMAL(18, 2)'),
+                           ('total_price', 'DECIMAL(18, 2)')], ('sales_order', 'sales_order_id')),
+    ('purchase_order_items', [('id', 'BIGINT'), ('purchase_order_id', 'BIGINT'), ('product_id', 'BIGINT'),
+                              ('quantity', 'BIGINT'), ('unit_price', 'DECIMAL(18, 2)'),
+                              ('total_price', 'DECIMAL(18, 2)')], ('purchase_order', 'purchase_order_id')),
+]
+
+SNAPSHOT_BATCH_SIZE = 5000
+
+# Report requests open the store read-only, so they never wait for DuckDB's
+# writer lock and any number of processes can read it. Snapshots alternate
+# between two store files: each brings the file readers are not using up to
+# date from that file's own change feed offset, then points readers at it by
+# rewriting a pointer file that holds the snapshot's generation number.
+REPORTS_POINTER_PATH = f'{REPORTS_DB_PATH}.current'
+# A store file held by another connection is retried this often until the timeout
+REPORTS_OPEN_RETRY = 0.1
+REPORTS_READ_TIMEOUT = 2
+SNAPSHOT_WRITE_TIMEOUT = 30
+
+snapshot_lock = threading.Lock()
+
+def reports_store_path(generation):
+    return f'{REPORTS_DB_PATH}.{generation % 2}'
+
+# Open the store readers are pointed at; None before the first snapshot. The
+# pointer is read again on each attempt: a reader that read it just before a
+# swap may find the next snapshot already writing that file.
+def open_reports_store():
+    deadline = time.monotonic() + REPORTS_READ_TIMEOUT
+    while True:
+        generation = read_offset(REPORTS_POINTER_PATH)
+        if not generation:
+            return None
+        try:
+            return duckdb.connect(reports_store_path(generation), read_only=True)
+        except duckdb.OperationalError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(REPORTS_OPEN_RETRY)
+
+# Open the store file readers are not pointed at for writing, once the last
+# reader left it; returns the generation it becomes and the connection
+def open_build_store():
+    deadline = time.monotonic() + SNAPSHOT_WRITE_TIMEOUT
+    while True:
+        generation = read_offset(REPORTS_POINTER_PATH) + 1
+        try:
+            duck = duckdb.connect(reports_store_path(generation))
+        except duckdb.OperationalError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(REPORTS_OPEN_RETRY)
+            continue
+        # Another process may have published this file while we waited for it
+        if read_offset(REPORTS_POINTER_PATH) < generation:
+            return generation, duck
+        duck.close()
+
+def create_reports_tables(duck):
+    for table, columns, _ in SNAPSHOT_TABLES:
+        column_defs = ', '.join(f'{name} {type_}' for name, type_ in columns)
+        duck.execute(f'CREATE TABLE IF NOT EXISTS {table} ({column_defs})')
+    duck.execute('CREATE TABLE IF NOT EXISTS snapshot_runs (finished_at TIMESTAMP, full_refresh BOOLEAN)')
+    duck.execute('CREATE TABLE IF NOT EXISTS snapshot_marks (table_name VARCHAR PRIMARY KEY, last_id BIGINT)')
+
+# Bring the reports store up to date and point readers at it
+def snapshot_reports(full=False):
+    with snapshot_lock:
+        generation, duck = open_build_store()
+        try:
+            create_reports_tables(duck)
+            conn = get_db_connection()
+            try:
+                copied = copy_snapshot_tables(conn, duck, full)
+            finally:
+                conn.close()
+            # Published before the file is released, so a snapshot waiting
+            # for the file finds it taken and moves on to the other one
+            write_offset(REPORTS_POINTER_PATH, generation)
+        finally:
+            duck.close()
+    return copied
+
+# Insert fetched rows as one columnar batch; DuckDB casts each column to the
+# table's type
+def load_batch(duck, table, columns, rows):
+    column_names = [name for name, _ in columns]
+    duck.register('batch', pa.Table.from_arrays([pa.array(values) for values in zip(*rows)], names=column_names))
+    try:
+        duck.execute(f"INSERT INTO {table} ({', '.join(column_names)}) SELECT * FROM batch")
+    finally:
+        duck.unregister('batch')
+
+# Copy the table's rows matching `where` into the store; returns the row count
+def copy_rows(conn, duck, table, columns, where, params=()):
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(name for name, _ in columns)} FROM {table} WHERE {where}", params)
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(SNAPSHOT_BATCH_SIZE)
+        if not rows:
+            return copied
+        load_batch(duck, table, columns, rows)
+        copied += len(rows)
+
+# Ids per entity named by the change feed after the offset, and the offset
+# they reach
+def read_changed_ids(conn, after):
+    changed = {}
+    while True:
+        changes = read_changes(conn, after, CHANGE_FEED_MAX_BATCH)
+        if not changes:
+            return changed, after
+        for change in changes:
+            changed.setdefault(change['entity'], set()).add(change['entity_id'])
+        after = changes[-1]['id']
+
+# Copy the database into the store; returns the rows copied per table. A
+# store with a change feed offset only re-copies the rows of entities named
+# by later events: their rows are deleted and copied again as they are now,
+# which carries edits and deletes over as well as new rows.
+def copy_snapshot_tables(conn, duck, full):
+    mark = None if full else duck.execute(
+        "SELECT last_id FROM snapshot_marks WHERE table_name = 'change_events'").fetchone()
+    if mark is None:
+        # Every event up to the settled id is committed, so the copy includes
+        # it; later events are replayed by the next snapshot
+        changed, offset = None, fetch_one(conn, SETTLED_CHANGE_QUERY, (CHANGE_FEED_SETTLE_SECONDS,)).last_id
+    else:
+        changed, offset = read_changed_ids(conn, mark[0])
+
+    copied = {}
+    duck.execute('BEGIN TRANSACTION')
+    try:
+        for table, columns, feed in SNAPSHOT_TABLES:
+            if changed is None or feed is None:
+                duck.execute(f'DELETE FROM {table}')
+                copied[table] = copy_rows(conn, duck, table, columns, '1 = 1')
+                continue
+            entity, key = feed
+            copied[table] = 0
+            for chunk in chunked(sorted(changed.get(entity, ()))):
+                duck.execute(f"DELETE FROM {table} WHERE {key} IN ({', '.join(['?'] * len(chunk))})", chunk)
+                copied[table] += copy_rows(conn, duck, table, columns, f'{key} IN ({placeholders_for(chunk)})', chunk)
+
+        duck.execute("DELETE FROM snapshot_marks WHERE table_name = 'change_events'")
+        duck.execute("INSERT INTO snapshot_marks VALUES ('change_events', ?)", (offset,))
+        duck.execute('INSERT INTO snapshot_runs VALUES (?, ?)', (datetime.now(), changed is None))
+        duck.execute('COMMIT')
+    except Exception:
+        duck.execute('ROLLBACK')
+        raise
+    return copied
+
+# Stock value per category
+def valuation_report(duck, start, end, limit):
+    return duck.execute('''
+        SELECT COALESCE(c.name, 'Uncategorized') AS category, COUNT(*) AS products,
+               SUM(p.quantity) AS units, SUM(p.quantity * p.unit_price) AS stock_value
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        GROUP BY 1
+        ORDER BY stock_value DESC
+        LIMIT ?
+    ''', (limit,))
+
+# Products ranked by units sold in the period
+def top_products_report(duck, start, end, limit):
+    return duck.execute('''
+        SELECT p.id AS product_id, p.name AS product, SUM(soi.quantity) AS units_sold, SUM(soi.total_price) AS revenue
+        FROM sales_order_items soi
+        JOIN sales_orders so ON soi.sales_order_id = so.id
+        JOIN products p ON soi.product_id = p.id
+        WHERE so.order_date >= ? AND so.order_date < ? AND so.status <> 'cancelled'
+        GROUP BY p.id, p.name
+        ORDER BY units_sold DESC
+        LIMIT ?
+    ''', (start, end, limit))
+
+# Sales in the period relative to the current stock, per product
+def turnover_report(duck, start, end, limit):
+    return duck.execute('''
+        WITH sold AS (
+            SELECT soi.product_id, SUM(soi.quantity) AS units_sold, SUM(soi.total_price) AS revenue
+            FROM sales_order_items soi
+            JOIN sales_orders so ON soi.sales_order_id = so.id
+            WHERE so.order_date >= ? AND so.order_date < ? AND so.status <> 'cancelled'
+            GROUP BY soi.product_id
+        )
+        SELECT p.id AS product_id, p.name AS product, p.quantity AS on_hand,
+               COALESCE(sold.units_sold, 0) AS units_sold,
+               p.quantity * p.unit_price AS stock_value,
+               COALESCE(sold.units_sold, 0) / NULLIF(p.quantity, 0) AS turnover
+        FROM products p
+        LEFT JOIN sold ON sold.product_id = p.id
+        ORDER BY turnover DESC NULLS LAST
+        LIMIT ?
+    ''', (start, end, limit))
+
+# ABC classification by share of revenue in the period (A: top 80%, B: next 15%, C: rest)
+def abc_report(duck, start, end, limit):
+    return duck.execute('''
+        WITH revenue AS (
+            SELECT soi.product_id, SUM(soi.total_price) AS revenue
+            FROM sales_order_items soi
+            JOIN sales_orders so ON soi.sales_order_id = so.id
+            WHERE so.order_date >= ? AND so.order_date < ? AND so.status <> 'cancelled'
+            GROUP BY soi.product_id
+        ), ranked AS (
+            SELECT product_id, revenue,
+                   SUM(revenue) OVER (ORDER BY revenue DESC, product_id ROWS UNBOUNDED PRECEDING)
+                       / SUM(revenue) OVER () AS cumulative_share,
+                   (SUM(revenue) OVER (ORDER BY revenue DESC, product_id ROWS UNBOUNDED PRECEDING) - revenue)
+                       / SUM(revenue) OVER () AS preceding_share
+            FROM revenue
+        )
+        SELECT r.product_id, p.name AS product, r.revenue, r.cumulative_share,
+               CASE WHEN r.preceding_share < 0.8 THEN 'A'
+                    WHEN r.preceding_share < 0.95 THEN 'B'
+                    ELSE 'C' END AS abc_class
+        FROM ranked r
+        LEFT JOIN products p ON r.product_id = p.id
+        ORDER BY r.revenue DESC
+        LIMIT ?
+    ''', (start, end, limit))
+
+# Purchase order spend per supplier in the period
+def supplier_spend_report(duck, start, end, limit):
+    return duck.execute('''
+        SELECT s.id AS supplier_id, COALESCE(s.name, 'Unknown') AS supplier, COUNT(DISTINCT po.id) AS orders,
+               SUM(poi.quantity) AS units, SUM(poi.total_price) AS spend
+        FROM purchase_order_items poi
+        JOIN purchase_orders po ON poi.purchase_order_id = po.id
+        LEFT JOIN suppliers s ON po.supplier_id = s.id
+        WHERE po.order_date >= ? AND po.order_date < ? AND po.status <> 'cancelled'
+        GROUP BY s.id, s.name
+        ORDER BY spend DESC
+        LIMIT ?
+    ''', (start, end, limit))
+
+REPORT_MAX_ROWS = 1000
+
+REPORTS = {
+    'valuation': valuation_report,
+    'top_products': top_products_report,
+    'turnover': turnover_report,
+    'abc': abc_report,
+    'supplier_spend': supplier_spend_report,
+}
+
+# Refresh the reports store
+@app.route('/reports/snapshot', methods=['POST'])
+@admission_control('reports', cost=lambda: SNAPSHOT_COST)
+def refresh_reports():
+    copied = snapshot_reports(full=request.form.get('full') == '1')
+    return jsonify({'copied': copied})
+
+# Run a report against the reports store
+@app.route('/reports/<report_name>', methods=['GET'])
+@admission_control('reports')
+def view_report(report_name):
+    report = REPORTS.get(report_name)
+    if report is None:
+        return jsonify({'error': 'Report not found'}), 404
+
+    # Period defaults to the last 90 days
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today() + timedelta(days=1)
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(days=90)
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'Invalid report parameters'}), 400
+    if not 1 <= limit <= REPORT_MAX_ROWS:
+        return jsonify({'error': 'Invalid report parameters'}), 400
+
+    duck = open_reports_store()
+    if duck is None:
+        return jsonify({'error': 'No reports snapshot yet'}), 503
+    try:
+        result = report(duck, start, end, limit)
+        columns = [column[0] for column in result.description]
+        rows = [dict(zip(columns, row)) for row in result.fetchall()]
+        last_snapshot = duck.execute('SELECT MAX(finished_at) FROM snapshot_runs').fetchone()[0]
+    finally:
+        duck.close()
+    return jsonify({'report': report_name, 'start': start.isoformat(), 'end': end.isoformat(),
+                    'snapshot_at': last_snapshot.isoformat() if last_snapshot else None, 'rows': rows})
+
+# Refresh the reports store from the command line: flask snapshot-reports [--full]
+@app.cli.command('snapshot-reports')
+@click.option('--full', is_flag=True, help='Recopy every table instead of only the rows that changed.')
+def snapshot_reports_command(full):
+    for table, count in snapshot_reports(full=full).items():
+        click.echo(f'{table}: {count} rows')
+
+# **Change feed**
+
+# Stock and order mutations go to the change_events outbox in the same
+# transaction as the change itself
+
+# Events younger than this may sit behind an id still held by an uncommitted transaction
+CHANGE_FEED_SETTLE_SECONDS = 2
+CHANGE_FEED_POLL_INTERVAL = 0.5
+CHANGE_FEED_MAX_BATCH = 1000
+CHANGE_FEED_MAX_WAIT = 30
+
+INSERT_CHANGE_EVENT_QUERY = Query('INSERT INTO change_events (entity, entity_id, operation, payload) VALUES (%s, %s, %s, %s)')
+CHANGES_QUERY = Query(f'''
+    SELECT id, entity, entity_id, operation, payload, created_at,
+           {dialect.older_than('created_at', '%s')} AS settled
+    FROM change_events
+    WHERE id > %s
+    ORDER BY id
+    LIMIT %s
+''')
+# Highest id of the settled events; every event up to it is committed
+SETTLED_CHANGE_QUERY = Query(f'''
+    SELECT COALESCE(MAX(id), 0) AS last_id FROM change_events WHERE {dialect.older_than('created_at', '%s')}
+''')
+
+# Add an event to the outbox; the caller commits it together with the change
+def record_change(conn, entity, entity_id, operation, payload):
+    execute(conn, INSERT_CHANGE_EVENT_QUERY, (entity, entity_id, operation, json.dumps(payload, default=str)))
+
+# Add the current quantity of each product to the outbox. Must run after the
+# product rows were updated, so the row locks keep events in commit order.
+def record_stock_changes(conn, product_ids):
+    product_ids = sorted({int(product_id) for product_id in product_ids})
+    if not product_ids:
+        return
+    cursor = conn.cursor()
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(f'SELECT id, quantity FROM products WHERE id IN ({placeholders})', product_ids)
+    record_changes(conn, 'product', 'stock',
+                   [(product_id, {'quantity': quantity}) for product_id, quantity in cursor.fetchall()])
+
+# Add one event per (entity_id, payload) pair with a single multi-row insert
+def record_changes(conn, entity, operation, changes):
+    if not changes:
+        return
+    cursor = conn.cursor()
+    cursor.executemany('INSERT INTO change_events (entity, entity_id, operation, payload) VALUES (%s, %s, %s, %s)',
+                       [(entity, entity_id, operation, json.dumps(payload, default=str))
+                        for entity_id, payload in changes])
+
+# Read committed events after the given offset. Auto-increment ids are handed
+# out before commit, so the batch stops at a gap until the gap has settled.
+def read_changes(conn, after, limit):
+    changes = []
+    expected_id = after + 1
+    for row in fetch_all(conn, CHANGES_QUERY, (CHANGE_FEED_SETTLE_SECONDS, after, limit)):
+        if row.id != expected_id and not row.settled:
+            break
+        changes.append({
+            'id': row.id,
+            'entity': row.entity,
+            'entity_id': row.entity_id,
+            'operation': row.operation,
+            'payload': json.loads(row.payload),
+            'created_at': row.created_at.isoformat(),
+        })
+        expected_id = row.id + 1
+    return changes
+
+# Wait up to `wait` seconds for events after the offset
+def poll_changes(after, limit, wait):
+    conn = get_db_connection()
+    conn.autocommit = True
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            changes = read_changes(conn, after, limit)
+            if changes or time.monotonic() >= deadline:
+                return changes
+            time.sleep(CHANGE_FEED_POLL_INTERVAL)
+    finally:
+        # Pooled sessions are reused as they are
+        conn.autocommit = False
+        conn.close()
+
+def parse_feed_args():
+    after = int(request.args.get('after', 0))
+    limit = min(int(request.args.get('limit', 100)), CHANGE_FEED_MAX_BATCH)
+    wait = float(request.args.get('wait', 0))
+    # nan compares false with everything, so it would pass the range check and never time out
+    if not math.isfinite(wait):
+        raise ValueError('wait is not a finite number')
+    wait = min(wait, CHANGE_FEED_MAX_WAIT)
+    if after < 0 or limit < 1 or wait < 0:
+        raise ValueError('negative feed parameter')
+    return after, limit, wait
+
+# Long-poll for changes: /changes?after=<offset>&limit=<n>&wait=<seconds>
+@app.route('/changes', methods=['GET'])
+@admission_control('feed')
+def view_changes():
+    try:
+        after, limit, wait = parse_feed_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid change feed parameters'}), 400
+
+    changes = poll_changes(after, limit, wait)
+    next_offset = changes[-1]['id'] if changes else after
+    return jsonify({'changes': changes, 'next_offset': next_offset})
+
+# Stream changes as server-sent events, resuming from Last-Event-ID
+@app.route('/changes/stream', methods=['GET'])
+@admission_control('stream')
+def stream_changes():
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid change feed parameters'}), 400
+
+    def generate(after):
+        while True:
+            changes = poll_changes(after, CHANGE_FEED_MAX_BATCH, CHANGE_FEED_MAX_WAIT / 2)
+            if not changes:
+                yield ': keep-alive\n\n'
+            for change in changes:
+                yield f"id: {change['id']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+                after = change['id']
+
+    return app.response_class(generate(after), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Create the outbox table: flask init-change-feed
+@app.cli.command('init-change-feed')
+def init_change_feed_command():
+    conn = get_db_connection()
+    conn.cursor().execute(dialect.change_events_ddl())
+    conn.commit()
+    conn.close()
+    click.echo('change_events table ready')
+
+def read_offset(offset_file):
+    try:
+        with open(offset_file) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def write_offset(offset_file, offset):
+    tmp_file = f'{offset_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, offset_file)
+
+# Deliver the change feed to a downstream endpoint in batches. The offset is
+# only saved after the target accepted a batch, so delivery is at-least-once
+# and consumers should skip event ids they have already applied.
+@app.cli.command('relay-changes')
+@click.option('--target', required=True, help='URL that receives each batch as a JSON POST.')
+@click.option('--offset-file', default='change_feed.offset', show_default=True)
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--once', is_flag=True, help='Deliver what is pending and exit.')
+def relay_changes_command(target, offset_file, batch_size, once):
+    offset = read_offset(offset_file)
+    batch_size = min(batch_size, CHANGE_FEED_MAX_BATCH)
+    retry_delay = 1
+    while True:
+        try:
+            changes = poll_changes(offset, batch_size, 0 if once else CHANGE_FEED_MAX_WAIT)
+            if changes:
+                body = json.dumps({'changes': changes, 'next_offset': changes[-1]['id']}).encode()
+                relay_request = urllib.request.Request(target, data=body, method='POST',
+                                                       headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(relay_request, timeout=30):
+                    pass
+                offset = changes[-1]['id']
+                write_offset(offset_file, offset)
+                click.echo(f'Delivered {len(changes)} changes up to offset {offset}')
+            elif once:
+                return
+            retry_delay = 1
+        except Exception as err:
+            click.echo(f'Change relay error: {err}', err=True)
+            if once:
+                raise SystemExit(1)
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+
+# **Site sync**
+
+# Change events replayed per upstream transaction
+SYNC_BATCH_SIZE = 500
+
+# Kept upstream: each site's offset in its own change_events outbox, and the
+# upstream ids its rows were given. Both are updated in the same transaction
+# as the rows they cover, so a batch of events is never applied twice.
+SITE_SYNC_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS site_sync (
+        site_id VARCHAR(64) NOT NULL,
+        table_name VARCHAR(64) NOT NULL,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (site_id, table_name)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS site_sync_rows (
+        site_id VARCHAR(64) NOT NULL,
+        table_name VARCHAR(64) NOT NULL,
+        site_row_id BIGINT NOT NULL,
+        upstream_id BIGINT NOT NULL,
+        PRIMARY KEY (site_id, table_name, site_row_id)
+    )
+    ''',
+]
+
+SYNC_EVENTS_QUERY = Query('SELECT id, entity, entity_id FROM change_events WHERE id > %s ORDER BY id LIMIT %s')
+
+def lock_site_sync(upstream_conn, table):
+    cursor = upstream_conn.cursor()
+    cursor.execute('INSERT IGNORE INTO site_sync (site_id, table_name) VALUES (%s, %s)', (SITE_ID, table))
+    cursor.execute('SELECT last_id FROM site_sync WHERE site_id = %s AND table_name = %s FOR UPDATE', (SITE_ID, table))
+    return cursor.fetchall()[0][0]
+
+def upstream_row_id(upstream_conn, table, site_row_id):
+    cursor = upstream_conn.cursor()
+    cursor.execute('SELECT upstream_id FROM site_sync_rows WHERE site_id = %s AND table_name = %s AND site_row_id = %s',
+                   (SITE_ID, table, site_row_id))
+    rows = cursor.fetchall()
+    return rows[0][0] if rows else None
+
+def map_site_row(upstream_conn, table, site_row_id, upstream_id):
+    upstream_conn.cursor().execute(
+        'INSERT INTO site_sync_rows (site_id, table_name, site_row_id, upstream_id) VALUES (%s, %s, %s, %s)',
+        (SITE_ID, table, site_row_id, upstream_id))
+
+def unmap_site_row(upstream_conn, table, site_row_id):
+    upstream_conn.cursor().execute('DELETE FROM site_sync_rows WHERE site_id = %s AND table_name = %s AND site_row_id = %s',
+                                   (SITE_ID, table, site_row_id))
+
+# Apply summed stock movements per product upstream. Products are updated in
+# id order, so the sync takes its row locks in a fixed order.
+def apply_stock_deltas(upstream_conn, deltas):
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    upstream_conn.cursor().executemany('UPDATE products SET quantity = quantity + %s WHERE id = %s',
+                                       [(deltas[product_id], product_id) for product_id in sorted(deltas)])
+    record_stock_changes(upstream_conn, deltas)
+
+def add_delta(deltas, product_id, delta):
+    deltas[product_id] = deltas.get(product_id, 0) + delta
+
+def transaction_delta(transaction_type, quantity):
+    return quantity if transaction_type == 'in' else -quantity if transaction_type == 'out' else 0
+
+# Make the upstream copy of a site transaction match the site's row: insert,
+# update or delete it, and add the stock difference to `deltas`
+def sync_transaction(conn, upstream_conn, transaction_id, deltas):
+    transaction = fetch_one(conn, TRANSACTION_QUERY, (transaction_id,))
+    upstream_id = upstream_row_id(upstream_conn, 'transactions', transaction_id)
+    cursor = upstream_conn.cursor()
+    if upstream_id is not None:
+        cursor.execute('SELECT product_id, transaction_type, quantity FROM transactions WHERE id = %s FOR UPDATE',
+                       (upstream_id,))
+        for product_id, transaction_type, quantity in cursor.fetchall():
+            add_delta(deltas, product_id, -transaction_delta(transaction_type, quantity))
+
+    if transaction is None:
+        if upstream_id is not None:
+            cursor.execute('DELETE FROM transactions WHERE id = %s', (upstream_id,))
+            unmap_site_row(upstream_conn, 'transactions', transaction_id)
+            record_change(upstream_conn, 'transaction', upstream_id, 'delete',
+                          {'site_id': SITE_ID, 'site_transaction_id': transaction_id})
+        return
+
+    add_delta(deltas, transaction.product_id, transaction_delta(transaction.transaction_type, transaction.quantity))
+    if upstream_id is None:
+        cursor.execute('INSERT INTO transactions (product_id, transaction_type, quantity, date) VALUES (%s, %s, %s, %s)',
+                       (transaction.product_id, transaction.transaction_type, transaction.quantity, transaction.date))
+        upstream_id, operation = cursor.lastrowid, 'insert'
+        map_site_row(upstream_conn, 'transactions', transaction_id, upstream_id)
+    else:
+        cursor.execute('UPDATE transactions SET product_id = %s, transaction_type = %s, quantity = %s WHERE id = %s',
+                       (transaction.product_id, transaction.transaction_type, transaction.quantity, upstream_id))
+        operation = 'update'
+    record_change(upstream_conn, 'transaction', upstream_id, operation,
+                  {'product_id': transaction.product_id, 'transaction_type': transaction.transaction_type,
+                   'quantity': transaction.quantity, 'site_id': SITE_ID, 'site_transaction_id': transaction_id})
+
+# Make the upstream copy of a site order match the site's order: insert it
+# with its items, change its status or delete it, and add the stock
+# difference to `deltas`. Order items never change after the order is created.
+def sync_order(conn, upstream_conn, order_id, deltas, kind):
+    order_kind = ORDER_KINDS[kind]
+    table, items_table, order_key = order_kind['table'], order_kind['items'], order_kind['order_key']
+    # Stock leaves with a sales order and arrives with a purchase order
+    sign = -1 if order_kind['revert_sign'] == '+' else 1
+
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {order_kind['party_key']}, order_date, status, total_amount, stock_returned "
+                   f"FROM {table} WHERE id = %s", (order_id,))
+    order = cursor.fetchone()
+    upstream_id = upstream_row_id(upstream_conn, table, order_id)
+    upstream_cursor = upstream_conn.cursor()
+    upstream_status, upstream_returned, upstream_items = None, False, []
+    if upstream_id is not None:
+        upstream_cursor.execute(f'SELECT status, stock_returned FROM {table} WHERE id = %s FOR UPDATE', (upstream_id,))
+        upstream_status, upstream_returned = upstream_cursor.fetchall()[0]
+        upstream_cursor.execute(f'SELECT product_id, quantity FROM {items_table} WHERE {order_key} = %s', (upstream_id,))
+        upstream_items = upstream_cursor.fetchall()
+
+    if order is None:
+        if upstream_id is not None:
+            if not upstream_returned:
+                for product_id, quantity in upstream_items:
+                    add_delta(deltas, product_id, -sign * quantity)
+            upstream_cursor.execute(f'DELETE FROM {items_table} WHERE {order_key} = %s', (upstream_id,))
+            upstream_cursor.execute(f'DELETE FROM {table} WHERE id = %s', (upstream_id,))
+            unmap_site_row(upstream_conn, table, order_id)
+            record_change(upstream_conn, f'{kind}_order', upstream_id, 'delete',
+                          {'site_id': SITE_ID, 'site_order_id': order_id})
+        return
+
+    party_id, order_date, status, total_amount, stock_returned = order
+    if upstream_id is None:
+        cursor.execute(f'SELECT product_id, quantity, unit_price, total_price FROM {items_table} WHERE {order_key} = %s',
+                       (order_id,))
+        items = cursor.fetchall()
+        upstream_cursor.execute(f"""
+            INSERT INTO {table} ({order_kind['party_key']}, order_date, status, total_amount, stock_returned)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (party_id, order_date, status, total_amount, stock_returned))
+        upstream_id = upstream_cursor.lastrowid
+        upstream_cursor.executemany(f"""
+            INSERT INTO {items_table} ({order_key}, product_id, quantity, unit_price, total_price)
+            VALUES (%s, %s, %s, %s, %s)
+        """, [(upstream_id,) + tuple(item) for item in items])
+        map_site_row(upstream_conn, table, order_id, upstream_id)
+        if not stock_returned:
+            for product_id, quantity, _, _ in items:
+                add_delta(deltas, product_id, sign * quantity)
+        record_change(upstream_conn, f'{kind}_order', upstream_id, 'insert',
+                      {order_kind['party_key']: party_id, 'status': status, 'total_amount': total_amount,
+                       'site_id': SITE_ID, 'site_order_id': order_id})
+    elif status != upstream_status or bool(stock_returned) != bool(upstream_returned):
+        upstream_cursor.execute(f'UPDATE {table} SET status = %s, stock_returned = %s WHERE id = %s',
+                                (status, stock_returned, upstream_id))
+        if bool(stock_returned) != bool(upstream_returned):
+            held = -1 if stock_returned else 1
+            for product_id, quantity in upstream_items:
+                add_delta(deltas, product_id, held * sign * quantity)
+        record_change(upstream_conn, f'{kind}_order', upstream_id, 'update',
+                      {'status': status, 'site_id': SITE_ID, 'site_order_id': order_id})
+
+# Entities of the site's change feed that are pushed upstream
+SYNC_ENTITIES = {
+    'transaction': sync_transaction,
+    'sales_order': functools.partial(sync_order, kind='sales'),
+    'purchase_order': functools.partial(sync_order, kind='purchase'),
+}
+
+# Push the site's transactions and orders to the central MySQL database by
+# replaying the site's change_events outbox. Each changed row is pushed in
+# its current state, so inserts, edits, cancellations and deletes all reach
+# upstream, and replaying a row twice changes nothing. The product, customer
+# and supplier ids they carry are the central ones (see pull_catalog).
+def sync_upstream(batch_size=SYNC_BATCH_SIZE):
+    upstream_conn = MySQLBackend(DB_CONFIG, 1).connect()
+    conn = get_db_connection()
+    pushed = dict.fromkeys(SYNC_ENTITIES, 0)
+    try:
+        for statement in SITE_SYNC_DDL:
+            upstream_conn.cursor().execute(statement)
+        add_order_stock_columns(upstream_conn, MySQLBackend.dialect)
+        while True:
+            last_id = lock_site_sync(upstream_conn, 'change_events')
+            events = fetch_all(conn, SYNC_EVENTS_QUERY, (last_id, batch_size))
+            if not events:
+                upstream_conn.rollback()
+                break
+            deltas = {}
+            for entity, entity_id in dict.fromkeys((event.entity, event.entity_id) for event in events):
+                if entity in SYNC_ENTITIES:
+                    SYNC_ENTITIES[entity](conn, upstream_conn, entity_id, deltas)
+                    pushed[entity] += 1
+            apply_stock_deltas(upstream_conn, deltas)
+            upstream_conn.cursor().execute('UPDATE site_sync SET last_id = %s WHERE site_id = %s AND table_name = %s',
+                                           (events[-1].id, SITE_ID, 'change_events'))
+            upstream_conn.commit()
+    finally:
+        upstream_conn.rollback()
+        upstream_conn.close()
+        conn.close()
+    return pushed
+
+# Catalog tables copied down to a site, with the columns copied besides the
+# id. A product's quantity is the site's own stock and is never copied.
+CATALOG_TABLES = [
+    ('categories', ['name']),
+    ('suppliers', ['name', 'contact_info']),
+    ('customers', ['name', 'contact_info']),
+    ('products', ['name', 'category_id', 'unit_price', 'supplier_id']),
+]
+
+# Catalog values compared as the site stores them: SQLite has no decimal type
+def catalog_values(row):
+    return tuple(float(value) if isinstance(value, Decimal) else value for value in row)
+
+# Make the site's catalog match the central one: new rows are inserted with
+# their central id, changed ones updated. Rows deleted centrally stay at the
+# site, whose history may still refer to them. New products start with no
+# stock and an opening balance of 0. Returns the rows inserted and updated
+# per table.
+def pull_catalog():
+    upstream_conn = MySQLBackend(DB_CONFIG, 1).connect()
+    conn = get_db_connection()
+    pulled = {}
+    try:
+        dialect.begin_write(conn)
+        for table, columns in CATALOG_TABLES:
+            column_list = ', '.join(['id'] + columns)
+            upstream_cursor = upstream_conn.cursor()
+            upstream_cursor.execute(f'SELECT {column_list} FROM {table} ORDER BY id')
+            rows = upstream_cursor.fetchall()
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {column_list} FROM {table}')
+            local = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+            inserted = [tuple(row) for row in rows if row[0] not in local]
+            updated = [tuple(row) for row in rows if row[0] in local and catalog_values(row[1:]) != local[row[0]]]
+            cursor.executemany(f"INSERT INTO {table} ({column_list}) VALUES ({placeholders_for(['id'] + columns)})",
+                               inserted)
+            cursor.executemany(f"UPDATE {table} SET {', '.join(f'{column} = %s' for column in columns)} WHERE id = %s",
+                               [row[1:] + row[:1] for row in updated])
+            if table == 'products':
+                cursor.executemany(INSERT_STOCK_OPENING_QUERY.sql, [(row[0], 0) for row in inserted])
+                for operation, changed in (('insert', inserted), ('update', updated)):
+                    record_changes(conn, 'product', operation,
+                                   [(row[0], dict(zip(columns, catalog_values(row[1:])))) for row in changed])
+            pulled[table] = (len(inserted), len(updated))
+        conn.commit()
+    finally:
+        upstream_conn.rollback()
+        upstream_conn.close()
+        conn.close()
+    return pulled
+
+# Create the local database of a SQLite site: flask init-site-db
+@app.cli.command('init-site-db')
+def init_site_db_command():
+    if DB_BACKEND != 'sqlite':
+        raise click.UsageError('init-site-db needs DB_BACKEND=sqlite')
+    db_backend.create_schema()
+    # Site databases created before the order tables had stock_returned
+    conn = get_db_connection()
+    add_order_stock_columns(conn, dialect)
+    conn.commit()
+    conn.close()
+    click.echo(f'{SQLITE_PATH} ready')
+
+# Copy the central catalog to the site: flask pull-catalog
+@app.cli.command('pull-catalog')
+def pull_catalog_command():
+    if DB_BACKEND != 'sqlite':
+        raise click.UsageError('pull-catalog needs DB_BACKEND=sqlite')
+    for table, (inserted, updated) in pull_catalog().items():
+        click.echo(f'{table}: {inserted} rows added, {updated} updated')
+
+# Push local transactions and orders upstream: flask sync-upstream
+@app.cli.command('sync-upstream')
+@click.option('--batch-size', default=SYNC_BATCH_SIZE, show_default=True)
+def sync_upstream_command(batch_size):
+    if DB_BACKEND != 'sqlite':
+        raise click.UsageError('sync-upstream needs DB_BACKEND=sqlite')
+    # Sites sharing an id would share their sync progress upstream
+    if not SITE_ID:
+        raise click.UsageError('sync-upstream needs SITE_ID set to a name unique to this site')
+    for entity, count in sync_upstream(batch_size).items():
+        click.echo(f'{entity}: {count} rows pushed')
+
+# **Stock audit**
+
+# products.quantity is changed in place, so it drifts from the recorded
+# movements when a request fails half way. The audit recomputes every
+# product's balance as its opening balance plus transactions and the items of
+# orders that still hold their stock, one range of product ids at a time.
+#
+# Runs are incremental: each product's movement sum is kept in
+# stock_movement_sums, with high-water marks on the movement tables and on the
+# change feed in stock_audit_marks. A run adds the movements above the marks
+# and sums again in full the products whose movements were edited, cancelled
+# or deleted since, which the change feed names. A stored sum that does not
+# match the product's quantity is always summed again before it is reported.
+AUDIT_CHUNK_SIZE = 1000
+
+# Stock movements per source table; {where} filters the movement rows `m`
+MOVEMENT_SOURCES = {
+    'transactions': '''
+        SELECT m.product_id,
+               CASE m.transaction_type WHEN 'in' THEN m.quantity WHEN 'out' THEN -m.quantity ELSE 0 END AS delta
+        FROM transactions m
+        WHERE {where}
+    ''',
+    'sales_order_items': '''
+        SELECT m.product_id, -m.quantity AS delta
+        FROM sales_order_items m
+        JOIN sales_orders o ON m.sales_order_id = o.id
+        WHERE {where} AND o.stock_returned = 0
+    ''',
+    'purchase_order_items': '''
+        SELECT m.product_id, m.quantity AS delta
+        FROM purchase_order_items m
+        JOIN purchase_orders o ON m.purchase_order_id = o.id
+        WHERE {where} AND o.stock_returned = 0
+    ''',
+}
+
+AUDIT_CHUNK_END_QUERY = Query('''
+    SELECT MAX(id) AS last_id
+    FROM (SELECT id FROM products WHERE id > %s ORDER BY id LIMIT %s) chunk
+''')
+STOCK_AUDIT_QUERY = Query('''
+    SELECT p.id AS product_id, p.quantity, o.quantity AS opening, s.moved
+    FROM products p
+    LEFT JOIN stock_openings o ON o.product_id = p.id
+    LEFT JOIN stock_movement_sums s ON s.product_id = p.id
+    WHERE p.id > %s AND p.id <= %s
+    ORDER BY p.id
+''')
+AUDIT_MARKS_QUERY = Query('SELECT source, last_id FROM stock_audit_marks')
+DELETE_AUDIT_MARK_QUERY = Query('DELETE FROM stock_audit_marks WHERE source = %s')
+INSERT_AUDIT_MARK_QUERY = Query('INSERT INTO stock_audit_marks (source, last_id) VALUES (%s, %s)')
+LAST_AUDIT_RUN_QUERY = Query('''
+    SELECT id, last_product_id, repair FROM stock_audit_runs WHERE finished_at IS NULL ORDER BY id DESC LIMIT 1
+''')
+INSERT_AUDIT_RUN_QUERY = Query('INSERT INTO stock_audit_runs (repair) VALUES (%s)')
+UPDATE_AUDIT_RUN_QUERY = Query('''
+    UPDATE stock_audit_runs
+    SET last_product_id = %s, products_checked = products_checked + %s, discrepancies = discrepancies + %s
+    WHERE id = %s
+''')
+FINISH_AUDIT_RUN_QUERY = Query('UPDATE stock_audit_runs SET finished_at = CURRENT_TIMESTAMP WHERE id = %s')
+
+# Sum the movements of the given sources per product
+def movement_sums(conn, sources, where, params):
+    union = ' UNION ALL '.join(MOVEMENT_SOURCES[source].format(where=where) for source in sources)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT product_id, SUM(delta) AS moved FROM ({union}) movements GROUP BY product_id',
+                   list(params) * len(sources))
+    return {product_id: int(moved) for product_id, moved in cursor.fetchall()}
+
+# Every movement of the given products
+def product_movement_sums(conn, product_ids):
+    moved = {}
+    for chunk in chunked(product_ids):
+        moved.update(movement_sums(conn, MOVEMENT_SOURCES, f'm.product_id IN ({placeholders_for(chunk)})', chunk))
+    return moved
+
+def save_audit_mark(conn, source, last_id):
+    execute(conn, DELETE_AUDIT_MARK_QUERY, (source,))
+    execute(conn, INSERT_AUDIT_MARK_QUERY, (source, last_id))
+
+def delete_movement_sums(conn, product_ids):
+    for chunk in chunked(product_ids):
+        conn.cursor().execute(f'DELETE FROM stock_movement_sums WHERE product_id IN ({placeholders_for(chunk)})', chunk)
+
+# Bring the stored movement sums up to date with the movements recorded since
+# the last run. Commits after each step.
+def refresh_movement_sums(conn):
+    marks = {row.source: row.last_id for row in fetch_all(conn, AUDIT_MARKS_QUERY)}
+    if 'change_events' not in marks:
+        # First run: no product has a sum yet, the audit chunks sum each one in full
+        conn.cursor().execute('DELETE FROM stock_movement_sums')
+        save_audit_mark(conn, 'change_events', fetch_one(conn, SETTLED_CHANGE_QUERY, (CHANGE_FEED_SETTLE_SECONDS,)).last_id)
+        for source in MOVEMENT_SOURCES:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {source}')
+            save_audit_mark(conn, source, cursor.fetchall()[0][0])
+        conn.commit()
+        return
+
+    # Products named by the change feed lose their sum and are summed again in full
+    offset = marks['change_events']
+    while True:
+        changes = read_changes(conn, offset, CHANGE_FEED_MAX_BATCH)
+        if not changes:
+            break
+        delete_movement_sums(conn, sorted({change['entity_id'] for change in changes if change['entity'] == 'product'}))
+        offset = changes[-1]['id']
+        save_audit_mark(conn, 'change_events', offset)
+        conn.commit()
+
+    # Movements above the marks are added to the products that still have a sum
+    for source in MOVEMENT_SOURCES:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {source}')
+        last_id = cursor.fetchall()[0][0]
+        if last_id <= marks[source]:
+            continue
+        moved = movement_sums(conn, [source], 'm.id > %s AND m.id <= %s', (marks[source], last_id))
+        conn.cursor().executemany('UPDATE stock_movement_sums SET moved = moved + %s WHERE product_id = %s',
+                                  [(delta, product_id) for product_id, delta in sorted(moved.items()) if delta])
+        save_audit_mark(conn, source, last_id)
+        conn.commit()
+
+# Audit the products after the given id; returns the last product id checked
+# (None once past the end), the number checked, the discrepancies and the ids
+# of products without an opening balance, which cannot be audited. Stored
+# movement sums are used when they agree with the quantity; other products
+# are summed again, and with `save_sums` their sums are stored. With `seed`,
+# products without an opening balance get one that accepts their current
+# quantity as correct, and with `repair` drifted quantities are set to the
+# expected value. The caller commits.
+def audit_stock_chunk(conn, after, limit, seed=False, repair=False, save_sums=False):
+    if seed or repair:
+        dialect.begin_write(conn)
+    end = fetch_one(conn, AUDIT_CHUNK_END_QUERY, (after, limit)).last_id
+    if end is None:
+        return None, 0, [], []
+
+    rows = fetch_all(conn, STOCK_AUDIT_QUERY, (after, end))
+    stale = [row.product_id for row in rows
+             if row.moved is None or row.opening is None or int(row.opening) + int(row.moved) != row.quantity]
+    moved_by_product = {row.product_id: row.moved for row in rows}
+    fresh = product_movement_sums(conn, stale)
+    for product_id in stale:
+        moved_by_product[product_id] = fresh.get(product_id, 0)
+    if save_sums and stale:
+        delete_movement_sums(conn, stale)
+        conn.cursor().executemany('INSERT INTO stock_movement_sums (product_id, moved) VALUES (%s, %s)',
+                                  [(product_id, moved_by_product[product_id]) for product_id in stale])
+
+    openings, discrepancies, no_baseline = [], [], []
+    for row in rows:
+        moved = int(moved_by_product[row.product_id])
+        if row.opening is None:
+            no_baseline.append(row.product_id)
+            openings.append((row.product_id, row.quantity - moved))
+            continue
+        expected = int(row.opening) + moved
+        if expected != row.quantity:
+            discrepancies.append({'product_id': row.product_id, 'quantity': row.quantity, 'expected': expected,
+                                  'difference': row.quantity - expected})
+
+    if seed and openings:
+        conn.cursor().executemany('INSERT INTO stock_openings (product_id, quantity) VALUES (%s, %s)', openings)
+    if repair and discrepancies:
+        # Only products that did not move since they were read
+        conn.cursor().executemany('UPDATE products SET quantity = %s WHERE id = %s AND quantity = %s',
+                                  [(d['expected'], d['product_id'], d['quantity']) for d in discrepancies])
+        record_stock_changes(conn, [d['product_id'] for d in discrepancies])
+    return end, len(rows), discrepancies, no_baseline
+
+# Audit one page of products: /audit/stock?after=<product_id>&limit=<n>.
+# POST with seed_openings=1 records missing opening balances, and with
+# repair=1 repairs drifted quantities.
+@app.route('/audit/stock', methods=['GET', 'POST'])
+@admission_control('reports')
+def audit_stock():
+    try:
+        after = int(request.values.get('after', 0))
+        limit = min(int(request.values.get('limit', AUDIT_CHUNK_SIZE)), AUDIT_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid audit parameters'}), 400
+    if after < 0 or limit < 1:
+        return jsonify({'error': 'Invalid audit parameters'}), 400
+
+    write = request.method == 'POST'
+    conn = get_db_connection()
+    end, checked, discrepancies, no_baseline = audit_stock_chunk(
+        conn, after, limit, seed=write and request.form.get('seed_openings') == '1',
+        repair=write and request.form.get('repair') == '1')
+    conn.commit()
+    conn.close()
+    return jsonify({'checked': checked, 'discrepancies': discrepancies, 'no_baseline': no_baseline,
+                    'next_after': end})
+
+# Create the stock audit tables: flask init-stock-audit
+@app.cli.command('init-stock-audit')
+def init_stock_audit_command():
+    conn = get_db_connection()
+    for statement in dialect.stock_audit_ddl():
+        conn.cursor().execute(statement)
+    conn.commit()
+    conn.close()
+    click.echo('stock audit tables ready')
+
+# Record an opening balance for every product that has none, accepting its
+# current quantity as correct
+def seed_stock_openings(conn, chunk_size):
+    after = seeded = 0
+    while True:
+        end, _, _, no_baseline = audit_stock_chunk(conn, after, chunk_size, seed=True)
+        conn.commit()
+        if end is None:
+            return seeded
+        after = end
+        seeded += len(no_baseline)
+
+# Audit every product: flask audit-stock [--repair] [--restart] [--full].
+# Progress is checkpointed after each chunk, so an interrupted run resumes
+# where it stopped. Products without an opening balance are listed, not
+# audited; seed them once with flask audit-stock --seed-openings.
+@app.cli.command('audit-stock')
+@click.option('--repair', is_flag=True, help='Set drifted quantities to the expected value.')
+@click.option('--restart', is_flag=True, help='Start a new run instead of resuming an unfinished one.')
+@click.option('--full', is_flag=True, help="Sum every product's movements again instead of only what changed.")
+@click.option('--seed-openings', is_flag=True,
+              help='Only record opening balances for products without one, accepting their current quantity.')
+@click.option('--chunk-size', default=AUDIT_CHUNK_SIZE, show_default=True)
+def audit_stock_command(repair, restart, full, seed_openings, chunk_size):
+    conn = get_db_connection()
+    if seed_openings:
+        seeded = seed_stock_openings(conn, chunk_size)
+        conn.close()
+        click.echo(f'Recorded opening balances for {seeded} products')
+        return
+
+    run = None if restart else fetch_one(conn, LAST_AUDIT_RUN_QUERY)
+    if run is None or bool(run.repair) != repair:
+        run_id, after = execute(conn, INSERT_AUDIT_RUN_QUERY, (repair,)).lastrowid, 0
+        conn.commit()
+    else:
+        run_id, after = run.id, run.last_product_id
+        click.echo(f'Resuming audit run {run_id} after product {after}')
+
+    if full:
+        conn.cursor().execute('DELETE FROM stock_audit_marks')
+    refresh_movement_sums(conn)
+
+    checked_total = drifted_total = unaudited_total = 0
+    while True:
+        end, checked, discrepancies, no_baseline = audit_stock_chunk(conn, after, chunk_size, repair=repair,
+                                                                     save_sums=True)
+        if end is None:
+            execute(conn, FINISH_AUDIT_RUN_QUERY, (run_id,))
+            conn.commit()
+            break
+        for d in discrepancies:
+            click.echo(f"product {d['product_id']}: quantity {d['quantity']}, expected {d['expected']} "
+                       f"({d['difference']:+d}){' repaired' if repair else ''}")
+        for product_id in no_baseline:
+            click.echo(f'product {product_id}: no opening balance')
+        execute(conn, UPDATE_AUDIT_RUN_QUERY, (end, checked, len(discrepancies), run_id))
+        conn.commit()
+        after = end
+        checked_total += checked
+        drifted_total += len(discrepancies)
+        unaudited_total += len(no_baseline)
+    conn.close()
+    click.echo(f'Audit run {run_id}: {checked_total} products checked, {drifted_total} discrepancies, '
+               f'{unaudited_total} without an opening balance')
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,90 @@
+"""Compare dictionary rows with the compact records returned by app.fetch_all.
+
+    python benchmarks/bench_data_access.py [rows]
+
+The row allocation part runs without a database. When DB_USER is set the
+script also times the products query on one connection, changing one thing at
+a time: the same column list through the text protocol and as a prepared
+statement (parse overhead), then SELECT * against the narrowed column list
+through the same protocol (column narrowing).
+"""
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app
+
+COLUMNS = ('id', 'name', 'category', 'quantity', 'unit_price', 'supplier')
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, size, elapsed
+
+
+def bench_rows(count):
+    raw = [(i, f'product {i}', 'category', i % 500, Decimal('9.99'), 'supplier') for i in range(count)]
+    record = namedtuple('Row', COLUMNS)
+
+    _, dict_size, dict_time = measure(lambda: [dict(zip(COLUMNS, row)) for row in raw])
+    _, record_size, record_time = measure(lambda: list(map(record._make, raw)))
+
+    print(f'{count} rows')
+    print(f'  dict rows:   {dict_size / count:7.1f} bytes/row  {dict_time * 1e9 / count:7.1f} ns/row')
+    print(f'  record rows: {record_size / count:7.1f} bytes/row  {record_time * 1e9 / count:7.1f} ns/row')
+
+
+def time_query(run, repeat):
+    run()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) * 1e3 / repeat
+
+
+def text_query(conn, sql):
+    def run():
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        cursor.fetchall()
+    return run
+
+
+def prepared_query(conn, query):
+    return lambda: app.execute(conn, query).fetchall()
+
+
+def bench_queries(repeat=200):
+    conn = app.get_db_connection()
+    if conn is None:
+        return
+
+    query = app.PRODUCT_OPTIONS_QUERY
+    text_time = time_query(text_query(conn, query.sql), repeat)
+    prepared_time = time_query(prepared_query(conn, query), repeat)
+    star_time = time_query(text_query(conn, 'SELECT * FROM products'), repeat)
+    conn.close()
+
+    print(f'products query x{repeat}')
+    print(f'  parse overhead, same columns: {query.sql}')
+    print(f'    text protocol:  {text_time:8.2f} ms/query')
+    print(f'    prepared:       {prepared_time:8.2f} ms/query')
+    print('  column narrowing, text protocol')
+    print(f'    SELECT *:       {star_time:8.2f} ms/query')
+    print(f'    narrowed:       {text_time:8.2f} ms/query')
+
+
+if __name__ == '__main__':
+    bench_rows(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    if os.environ.get('DB_USER'):
+        bench_queries()
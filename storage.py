@@ -0,0 +1,384 @@
+import queue
+import re
+import sqlite3
+import threading
+from decimal import Decimal
+
+import mysql.connector
+import mysql.connector.errorcode
+import mysql.connector.pooling
+
+# **Dialects**
+
+# SQL that differs between the engines. Statements in app.py are written with
+# %s placeholders; the SQLite connection translates them.
+class MySQLDialect:
+    name = 'mysql'
+    for_update = ' FOR UPDATE'
+
+    # Start a transaction whose reads decide what it writes. InnoDB locks the
+    # rows read with for_update, so there is nothing to do up front.
+    def begin_write(self, conn):
+        pass
+
+    # Condition that `column` is more than `seconds` (a placeholder) in the past
+    def older_than(self, column, seconds):
+        return f'{column} < NOW(6) - INTERVAL {seconds} SECOND'
+
+    # UPDATE `table` from a derived table joined on `condition`
+    def update_from(self, table, column, expression, source, alias, condition):
+        return f'UPDATE {table} JOIN ({source}) {alias} ON {condition} SET {table}.{column} = {expression}'
+
+    # Add a column to an existing table unless it has it already
+    def add_column(self, conn, table, column, definition):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        ''', (table, column))
+        if not cursor.fetchall()[0][0]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def change_events_ddl(self):
+        return '''
+            CREATE TABLE IF NOT EXISTS change_events (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                entity VARCHAR(32) NOT NULL,
+                entity_id BIGINT NOT NULL,
+                operation VARCHAR(16) NOT NULL,
+                payload JSON NOT NULL,
+                created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+            )
+        '''
+
+    def stock_audit_ddl(self):
+        return [
+            '''
+            CREATE TABLE IF NOT EXISTS stock_openings (
+                product_id BIGINT PRIMARY KEY,
+                quantity BIGINT NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_movement_sums (
+                product_id BIGINT PRIMARY KEY,
+                moved BIGINT NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_audit_marks (
+                source VARCHAR(32) PRIMARY KEY,
+                last_id BIGINT NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_audit_runs (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP NULL,
+                last_product_id BIGINT NOT NULL DEFAULT 0,
+                products_checked BIGINT NOT NULL DEFAULT 0,
+                discrepancies BIGINT NOT NULL DEFAULT 0,
+                repair BOOLEAN NOT NULL DEFAULT FALSE
+            )
+            ''',
+        ]
+
+class SQLiteDialect:
+    name = 'sqlite'
+    # SQLite has no row locks, see begin_write
+    for_update = ''
+
+    # sqlite3 only opens a transaction at the first write, so a read before
+    # it is not protected. Take the database write lock before reading.
+    def begin_write(self, conn):
+        conn.begin_immediate()
+
+    def older_than(self, column, seconds):
+        return f"{column} < strftime('%Y-%m-%d %H:%M:%f', 'now', '-' || {seconds} || ' seconds')"
+
+    def update_from(self, table, column, expression, source, alias, condition):
+        return f'UPDATE {table} SET {column} = {expression} FROM ({source}) AS {alias} WHERE {condition}'
+
+    def add_column(self, conn, table, column, definition):
+        cursor = conn.cursor()
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def change_events_ddl(self):
+        return '''
+            CREATE TABLE IF NOT EXISTS change_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entity TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                operation TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            )
+        '''
+
+    def stock_audit_ddl(self):
+        return [
+            '''
+            CREATE TABLE IF NOT EXISTS stock_openings (
+                product_id INTEGER PRIMARY KEY,
+                quantity INTEGER NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_movement_sums (
+                product_id INTEGER PRIMARY KEY,
+                moved INTEGER NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_audit_marks (
+                source TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS stock_audit_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                last_product_id INTEGER NOT NULL DEFAULT 0,
+                products_checked INTEGER NOT NULL DEFAULT 0,
+                discrepancies INTEGER NOT NULL DEFAULT 0,
+                repair INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+        ]
+
+# **MySQL**
+
+class MySQLBackend:
+    dialect = MySQLDialect()
+
+    def __init__(self, config, pool_size):
+        self.config = config
+        self.pool_size = pool_size
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def connect(self):
+        try:
+            with self.pool_lock:
+                if self.pool is None:
+                    # Pooled sessions are kept between requests so their prepared statements can be reused
+                    self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                        pool_name='warehouse', pool_size=self.pool_size, pool_reset_session=False, **self.config)
+            try:
+                conn = self.pool.get_connection()
+            except mysql.connector.errors.PoolError:
+                # Every pooled session is busy, use a dedicated connection
+                return mysql.connector.connect(**self.config)
+            # Sessions are not reset, so end any transaction the previous request left open
+            conn.rollback()
+            return conn
+        except mysql.connector.Error as err:
+            if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
+                print("Authentication error: Invalid username or password")
+            elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
+                print("Database does not exist")
+            else:
+                print(f'Database connection error: {err}')
+            return None
+
+# **SQLite**
+
+PLACEHOLDER = re.compile(r'%s')
+
+# Prices read from MySQL come back as Decimal; NUMERIC columns store the text as a number
+sqlite3.register_adapter(Decimal, str)
+
+# Cursor with the parts of the mysql.connector cursor API that app.py uses
+class SQLiteCursor:
+    def __init__(self, cursor, dictionary=False):
+        self.cursor = cursor
+        self.dictionary = dictionary
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(PLACEHOLDER.sub('?', sql), params)
+
+    def executemany(self, sql, seq_params):
+        self.cursor.executemany(PLACEHOLDER.sub('?', sql), seq_params)
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self.cursor.description or ())
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def convert(self, rows):
+        if not self.dictionary:
+            return rows
+        columns = self.column_names
+        return [dict(zip(columns, row)) for row in rows]
+
+    def fetchall(self):
+        return self.convert(self.cursor.fetchall())
+
+    def fetchmany(self, size):
+        return self.convert(self.cursor.fetchmany(size))
+
+    def fetchone(self):
+        rows = self.convert(self.cursor.fetchmany(1))
+        return rows[0] if rows else None
+
+# Pooled connection; close() hands it back to the backend
+class SQLiteConnection:
+    def __init__(self, backend, conn):
+        self.backend = backend
+        self.conn = conn
+        self.connection_id = id(conn)
+
+    # `prepared` is accepted for API compatibility, sqlite3 already caches
+    # compiled statements per connection
+    def cursor(self, dictionary=False, prepared=False):
+        return SQLiteCursor(self.conn.cursor(), dictionary=dictionary)
+
+    @property
+    def autocommit(self):
+        return self.conn.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self.conn.isolation_level = None if value else ''
+
+    def begin_immediate(self):
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.rollback()
+        self.backend.release(self)
+
+class SQLiteBackend:
+    dialect = SQLiteDialect()
+
+    def __init__(self, path, pool_size):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=pool_size)
+
+    def open(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        # WAL lets readers run alongside the single writer; NORMAL sync is
+        # still crash safe in WAL mode and keeps commits off the fsync path
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return SQLiteConnection(self, conn)
+
+    def connect(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.open()
+        except sqlite3.Error as err:
+            print(f'Database connection error: {err}')
+            return None
+
+    def release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.conn.close()
+
+    def create_schema(self):
+        conn = self.open()
+        conn.conn.executescript(SQLITE_SCHEMA)
+        conn.conn.execute(self.dialect.change_events_ddl())
+        for statement in self.dialect.stock_audit_ddl():
+            conn.conn.execute(statement)
+        conn.commit()
+        conn.conn.close()
+
+# Schema of a local site database, mirroring the central MySQL tables
+SQLITE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        contact_info TEXT
+    );
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS suppliers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        contact_info TEXT
+    );
+    CREATE TABLE IF NOT EXISTS warehouses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        category_id INTEGER,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        unit_price NUMERIC NOT NULL,
+        supplier_id INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS transactions_product_id ON transactions (product_id);
+    CREATE TABLE IF NOT EXISTS sales_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        order_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        status TEXT NOT NULL DEFAULT 'pending',
+        total_amount NUMERIC NOT NULL DEFAULT 0,
+        stock_returned INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS sales_order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sales_order_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price NUMERIC NOT NULL,
+        total_price NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sales_order_items_order_id ON sales_order_items (sales_order_id);
+    CREATE INDEX IF NOT EXISTS sales_order_items_product_id ON sales_order_items (product_id);
+    CREATE TABLE IF NOT EXISTS purchase_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        supplier_id INTEGER NOT NULL,
+        order_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        status TEXT NOT NULL DEFAULT 'pending',
+        total_amount NUMERIC NOT NULL DEFAULT 0,
+        stock_returned INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS purchase_order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        purchase_order_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price NUMERIC NOT NULL,
+        total_price NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS purchase_order_items_order_id ON purchase_order_items (purchase_order_id);
+    CREATE INDEX IF NOT EXISTS purchase_order_items_product_id ON purchase_order_items (product_id);
+'''
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# The app picks its storage engine at import time
+os.environ['DB_BACKEND'] = 'sqlite'
+
+import app as warehouse
+from storage import SQLiteBackend
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    backend = SQLiteBackend(str(tmp_path / 'warehouse.sqlite3'), 4)
+    backend.create_schema()
+    monkeypatch.setattr(warehouse, 'db_backend', backend)
+    for gate in warehouse.route_gates.values():
+        gate.buckets.clear()
+    return backend
+
+
+@pytest.fixture
+def client(db):
+    return warehouse.app.test_client()
+
+
+# One customer, one supplier and two products: 1 with 100 units, 2 with 50
+@pytest.fixture
+def catalog(db):
+    sql(db, "INSERT INTO customers (name, contact_info) VALUES ('Customer', 'c@example.com')")
+    sql(db, "INSERT INTO suppliers (name, contact_info) VALUES ('Supplier', 's@example.com')")
+    sql(db, "INSERT INTO products (name, quantity, unit_price, supplier_id) VALUES ('Bolt', 100, 2, 1)")
+    sql(db, "INSERT INTO products (name, quantity, unit_price, supplier_id) VALUES ('Nut', 50, 3, 1)")
+    return db
+
+
+def sql(db, statement, params=()):
+    conn = db.connect()
+    cursor = conn.cursor()
+    cursor.execute(statement, params)
+    rows = cursor.fetchall()
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def quantities(db):
+    return dict(sql(db, 'SELECT id, quantity FROM products ORDER BY id'))
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from conftest import warehouse
+from test_orders import add_purchase_order
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(warehouse.time, 'monotonic', lambda: now[0])
+    return now
+
+
+# The HTML templates are not part of the tests; pages render their context instead
+@pytest.fixture
+def pages(monkeypatch):
+    rendered = []
+
+    def render_template(template, **context):
+        rendered.append(context)
+        return template
+    monkeypatch.setattr(warehouse, 'render_template', render_template)
+    return rendered
+
+
+def test_bucket_refills_at_the_rate(clock):
+    gate = warehouse.RouteGate(rate=2, burst=4, concurrency=1, queue=0, queue_timeout=0)
+    assert [gate.take('client', 1) for _ in range(4)] == [0, 0, 0, 0]
+    assert gate.take('client', 1) == 0.5
+    assert gate.take('other', 1) == 0
+
+    clock[0] += 0.5
+    assert gate.take('client', 1) == 0
+    # Costs above the burst are capped, so a heavy request can still get through
+    clock[0] += 10
+    assert gate.take('client', 9) == 0
+    assert gate.take('client', 1) == 0.5
+
+
+def test_over_rate_requests_get_429_with_retry_after(client, db, clock):
+    # The reports class refills one token a second and bursts to 20
+    for _ in range(20):
+        assert client.get('/reports/missing').status_code == 404
+    response = client.get('/reports/missing')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+    clock[0] += 3
+    assert [client.get('/reports/missing').status_code for _ in range(4)] == [404, 404, 404, 429]
+
+
+def test_retry_after_covers_the_cost_of_the_request(client, catalog, clock, pages):
+    # A 1000-row page costs 10 tokens out of the list class's burst of 20
+    assert client.get('/purchase_orders?per_page=1000').status_code == 200
+    assert client.get('/purchase_orders?per_page=1000').status_code == 200
+    response = client.get('/purchase_orders?per_page=1000')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert client.get('/purchase_orders?per_page=100').status_code == 429
+
+    clock[0] += 0.2
+    assert client.get('/purchase_orders?per_page=100').status_code == 200
+
+
+def test_requests_are_shed_with_503_when_the_queue_is_full(client, db):
+    # The feed class has no queue: once its slots are taken, requests are turned away
+    gate = warehouse.route_gates['feed']
+    held = 0
+    while gate.slots.acquire(blocking=False):
+        held += 1
+    try:
+        response = client.get('/changes')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+    finally:
+        for _ in range(held):
+            gate.leave()
+    assert client.get('/changes').status_code == 200
+
+
+def test_queued_request_gets_the_next_free_slot():
+    gate = warehouse.RouteGate(rate=1, burst=1, concurrency=1, queue=1, queue_timeout=5)
+    assert gate.enter()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(gate.enter()))
+    waiter.start()
+    while gate.waiting < 1:
+        time.sleep(0.01)
+    # The only queue place is taken
+    assert not gate.enter()
+
+    gate.leave()
+    waiter.join()
+    assert results == [True]
+    gate.leave()
+
+
+def test_queued_request_gives_up_after_the_timeout():
+    gate = warehouse.RouteGate(rate=1, burst=1, concurrency=1, queue=1, queue_timeout=0.1)
+    assert gate.enter()
+    assert not gate.enter()
+    assert gate.waiting == 0
+
+
+def test_purchase_orders_are_paged_newest_first(client, catalog, pages):
+    for quantity in (1, 2, 3):
+        add_purchase_order(client, [(1, quantity)])
+
+    client.get('/purchase_orders?per_page=2')
+    client.get('/purchase_orders?per_page=2&page=2')
+    assert [([order.id for order in page['purchase_orders']], page['has_next']) for page in pages] == [
+        ([3, 2], True), ([1], False)]
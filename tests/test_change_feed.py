@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from conftest import sql, warehouse
+from test_orders import add_sales_order
+
+
+@pytest.fixture
+def events(db):
+    # Ids 1, 2 and 4: id 3 is a gap, as left by a transaction that has not committed yet
+    for event_id in (1, 2, 4):
+        add_event(db, event_id)
+    return db
+
+
+def add_event(db, event_id):
+    sql(db, '''
+        INSERT INTO change_events (id, entity, entity_id, operation, payload) VALUES (%s, 'product', %s, 'stock', '{}')
+    ''', (event_id, event_id))
+
+
+def settle(db, event_id):
+    sql(db, "UPDATE change_events SET created_at = strftime('%Y-%m-%d %H:%M:%f', 'now', '-1 minute') WHERE id = %s",
+        (event_id,))
+
+
+def event_ids(response):
+    return [change['id'] for change in response.get_json()['changes']]
+
+
+def test_feed_returns_events_after_the_offset(client, catalog):
+    add_sales_order(client, [(1, 4), (2, 1)])
+
+    response = client.get('/changes')
+    changes = response.get_json()['changes']
+    assert [(change['entity'], change['entity_id'], change['operation']) for change in changes] == [
+        ('sales_order', 1, 'insert'), ('product', 1, 'stock'), ('product', 2, 'stock')]
+    assert changes[1]['payload'] == {'quantity': 96}
+    assert response.get_json()['next_offset'] == 3
+
+    response = client.get('/changes?after=1&limit=1')
+    assert event_ids(response) == [2]
+    assert response.get_json()['next_offset'] == 2
+    assert client.get('/changes?after=3').get_json() == {'changes': [], 'next_offset': 3}
+
+
+def test_feed_stops_at_a_gap_until_it_settles(client, events):
+    response = client.get('/changes')
+    assert event_ids(response) == [1, 2]
+    assert response.get_json()['next_offset'] == 2
+    assert event_ids(client.get('/changes?after=2')) == []
+
+    # Once the event after the gap is old enough, the gap is taken as a rolled back id
+    settle(events, 4)
+    response = client.get('/changes?after=2')
+    assert event_ids(response) == [4]
+    assert response.get_json()['next_offset'] == 4
+
+
+def test_feed_skips_no_event_that_commits_into_the_gap(client, events):
+    assert event_ids(client.get('/changes')) == [1, 2]
+    add_event(events, 3)
+    assert event_ids(client.get('/changes?after=2')) == [3, 4]
+
+
+def test_long_poll_waits_for_the_timeout_when_nothing_is_new(client, events, monkeypatch):
+    monkeypatch.setattr(warehouse, 'CHANGE_FEED_POLL_INTERVAL', 0.05)
+    started = time.monotonic()
+    assert event_ids(client.get('/changes?after=4&wait=0.2')) == []
+    assert 0.2 <= time.monotonic() - started < 2
+
+
+@pytest.mark.parametrize('query', ['after=-1', 'after=x', 'limit=0', 'wait=-1', 'wait=nan', 'wait=inf', 'wait=x'])
+def test_invalid_feed_parameters_are_rejected(client, db, query):
+    assert client.get(f'/changes?{query}').status_code == 400
@@ -0,0 +1,179 @@
+import threading
+import time
+
+from conftest import quantities, sql, warehouse
+
+
+def add_sales_order(client, items):
+    response = client.post('/add_sales_order', data={
+        'customer_id': 1,
+        'product_id[]': [product_id for product_id, _ in items],
+        'quantity[]': [quantity for _, quantity in items],
+    })
+    assert response.status_code == 302
+
+
+def add_purchase_order(client, items):
+    response = client.post('/add_purchase_order', data={
+        'supplier_id': 1,
+        'product_id[]': [product_id for product_id, _ in items],
+        'quantity[]': [quantity for _, quantity in items],
+    })
+    assert response.status_code == 302
+
+
+def status_of(db, table, order_id):
+    return sql(db, f'SELECT status FROM {table} WHERE id = %s', (order_id,))[0][0]
+
+
+def test_sales_order_takes_stock_and_cancel_returns_it(client, catalog):
+    add_sales_order(client, [(1, 3), (2, 2), (1, 1)])
+    assert quantities(catalog) == {1: 96, 2: 48}
+
+    assert client.post('/edit_sales_order/1', data={'status': 'cancelled'}).status_code == 302
+    assert status_of(catalog, 'sales_orders', 1) == 'cancelled'
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+    # Already cancelled: left alone, stock is not returned twice
+    assert client.post('/edit_sales_order/1', data={'status': 'cancelled'}).status_code == 302
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+
+def test_purchase_order_cancel_removes_stock(client, catalog):
+    add_purchase_order(client, [(1, 10), (2, 5)])
+    assert quantities(catalog) == {1: 110, 2: 55}
+
+    assert client.post('/edit_purchase_order/1', data={'status': 'cancelled'}).status_code == 302
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+
+def test_status_changes_follow_the_state_machine(client, catalog):
+    add_sales_order(client, [(1, 1)])
+
+    assert client.post('/edit_sales_order/1', data={'status': 'shipped'}).status_code == 302
+    assert client.post('/edit_sales_order/1', data={'status': 'pending'}).status_code == 409
+    assert client.post('/edit_sales_order/1', data={'status': 'cancelled'}).status_code == 409
+    assert client.post('/edit_sales_order/1', data={'status': 'delivered'}).status_code == 302
+    assert status_of(catalog, 'sales_orders', 1) == 'delivered'
+    assert quantities(catalog) == {1: 99, 2: 50}
+
+
+def test_unknown_target_status_is_rejected(client, catalog):
+    add_sales_order(client, [(1, 1)])
+    assert client.post('/edit_sales_order/1', data={'status': 'lost'}).status_code == 400
+    assert status_of(catalog, 'sales_orders', 1) == 'pending'
+
+
+def test_order_with_unlisted_status_can_still_move(client, catalog):
+    add_sales_order(client, [(1, 4)])
+    sql(catalog, "UPDATE sales_orders SET status = 'On hold' WHERE id = 1")
+
+    assert client.post('/edit_sales_order/1', data={'status': 'cancelled'}).status_code == 302
+    assert status_of(catalog, 'sales_orders', 1) == 'cancelled'
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+
+def test_editing_a_missing_order_returns_404(client, catalog):
+    assert client.post('/edit_sales_order/999', data={'status': 'shipped'}).status_code == 404
+    assert client.post('/edit_purchase_order/999', data={'status': 'received'}).status_code == 404
+
+
+def test_batch_update_reports_each_order(client, catalog):
+    add_sales_order(client, [(1, 1)])
+    add_sales_order(client, [(1, 2)])
+    add_sales_order(client, [(2, 3)])
+    client.post('/edit_sales_order/2', data={'status': 'cancelled'})
+
+    response = client.post('/batch_update_sales_orders', data={'status': 'shipped', 'order_id[]': [1, 2, 3, 999, 1]})
+    assert response.status_code == 200
+    assert response.get_json() == {'status': 'shipped', 'updated': [1, 3], 'skipped': [2], 'missing': [999]}
+    assert [status_of(catalog, 'sales_orders', order_id) for order_id in (1, 2, 3)] == ['shipped', 'cancelled', 'shipped']
+
+
+def test_batch_cancel_returns_stock_of_every_order(client, catalog):
+    add_sales_order(client, [(1, 1), (2, 1)])
+    add_sales_order(client, [(1, 2)])
+    add_sales_order(client, [(2, 3)])
+    client.post('/edit_sales_order/3', data={'status': 'shipped'})
+
+    response = client.post('/batch_update_sales_orders', data={'status': 'cancelled', 'order_id[]': [1, 2, 3]})
+    assert response.get_json()['updated'] == [1, 2]
+    assert response.get_json()['skipped'] == [3]
+    assert quantities(catalog) == {1: 100, 2: 47}
+
+
+def test_batch_delete_skips_the_stock_of_cancelled_orders(client, catalog):
+    add_sales_order(client, [(1, 5), (2, 5)])
+    add_sales_order(client, [(1, 7)])
+    add_purchase_order(client, [(2, 20)])
+    client.post('/edit_sales_order/2', data={'status': 'cancelled'})
+    assert quantities(catalog) == {1: 95, 2: 65}
+
+    response = client.post('/batch_delete_sales_orders', data={'order_id[]': [1, 2, 999]})
+    assert response.get_json() == {'deleted': [1, 2]}
+    assert quantities(catalog) == {1: 100, 2: 70}
+    assert sql(catalog, 'SELECT COUNT(*) FROM sales_orders')[0][0] == 0
+    assert sql(catalog, 'SELECT COUNT(*) FROM sales_order_items')[0][0] == 0
+
+
+def test_deleting_an_order_cancelled_as_plain_text_returns_its_stock(client, catalog):
+    add_sales_order(client, [(1, 10)])
+    add_purchase_order(client, [(2, 5)])
+    # The edit forms used to store the status without returning any stock
+    sql(catalog, "UPDATE sales_orders SET status = 'cancelled' WHERE id = 1")
+    sql(catalog, "UPDATE purchase_orders SET status = 'cancelled' WHERE id = 1")
+    assert quantities(catalog) == {1: 90, 2: 55}
+
+    assert client.post('/delete_sales_order/1').status_code == 302
+    assert client.post('/delete_purchase_order/1').status_code == 302
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+
+def test_cancelling_marks_the_stock_returned(client, catalog):
+    add_sales_order(client, [(1, 10)])
+    add_sales_order(client, [(1, 5)])
+    client.post('/edit_sales_order/1', data={'status': 'cancelled'})
+    assert sql(catalog, 'SELECT id, stock_returned FROM sales_orders ORDER BY id') == [(1, 1), (2, 0)]
+
+
+def test_init_order_stock_adds_the_column_to_existing_tables(client, catalog):
+    add_sales_order(client, [(1, 10)])
+    sql(catalog, "UPDATE sales_orders SET status = 'cancelled' WHERE id = 1")
+    sql(catalog, 'ALTER TABLE sales_orders DROP COLUMN stock_returned')
+
+    result = warehouse.app.test_cli_runner().invoke(args=['init-order-stock'])
+    assert result.exit_code == 0, result.output
+    assert sql(catalog, 'SELECT stock_returned FROM sales_orders') == [(0,)]
+    client.post('/delete_sales_order/1')
+    assert quantities(catalog) == {1: 100, 2: 50}
+
+
+def test_batch_requests_need_order_ids_and_a_known_status(client, catalog):
+    assert client.post('/batch_update_sales_orders', data={'status': 'shipped'}).status_code == 400
+    assert client.post('/batch_update_sales_orders', data={'status': 'lost', 'order_id[]': [1]}).status_code == 400
+    assert client.post('/batch_delete_purchase_orders', data={'order_id[]': ['x']}).status_code == 400
+
+
+def test_concurrent_cancels_return_stock_once(catalog, client):
+    add_sales_order(client, [(1, 1)])
+    barrier = threading.Barrier(2)
+    results = []
+
+    def cancel():
+        conn = catalog.connect()
+        barrier.wait()
+        updated, _, _ = warehouse.change_order_status(conn, 'sales', [1], 'cancelled')
+        # Hold the transaction open so the other request reads while it is pending
+        time.sleep(0.2)
+        conn.commit()
+        conn.close()
+        results.append(updated)
+
+    threads = [threading.Thread(target=cancel) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [[], [1]]
+    assert quantities(catalog) == {1: 100, 2: 50}
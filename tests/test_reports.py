@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import quantities, sql, warehouse
+from test_orders import add_sales_order
+from test_stock_audit import add_transaction
+
+
+@pytest.fixture
+def reports(catalog, tmp_path, monkeypatch):
+    # Every change event counts as settled, so snapshots pick them up at once
+    monkeypatch.setattr(warehouse, 'CHANGE_FEED_SETTLE_SECONDS', 0)
+    monkeypatch.setattr(warehouse, 'REPORTS_DB_PATH', str(tmp_path / 'reports.duckdb'))
+    monkeypatch.setattr(warehouse, 'REPORTS_POINTER_PATH', str(tmp_path / 'reports.duckdb.current'))
+    return catalog
+
+
+def store_rows(query):
+    duck = warehouse.open_reports_store()
+    try:
+        return duck.execute(query).fetchall()
+    finally:
+        duck.close()
+
+
+def test_reports_wait_for_the_first_snapshot(client, reports):
+    assert client.get('/reports/valuation').status_code == 503
+
+    assert client.post('/reports/snapshot').status_code == 200
+    response = client.get('/reports/valuation')
+    assert response.status_code == 200
+    assert response.get_json()['rows'][0]['units'] == 150
+
+
+def test_snapshots_alternate_between_two_store_files(client, reports, tmp_path):
+    warehouse.snapshot_reports()
+    # A reader keeps the file it opened while the next snapshot writes the other one
+    duck = warehouse.open_reports_store()
+    add_sales_order(client, [(1, 4)])
+    warehouse.snapshot_reports()
+    assert duck.execute('SELECT COUNT(*) FROM sales_orders').fetchall() == [(0,)]
+    duck.close()
+
+    assert store_rows('SELECT COUNT(*) FROM sales_orders') == [(1,)]
+    assert warehouse.read_offset(warehouse.REPORTS_POINTER_PATH) == 2
+    assert (tmp_path / 'reports.duckdb.0').exists() and (tmp_path / 'reports.duckdb.1').exists()
+
+
+def test_snapshot_recopies_only_the_rows_that_changed(client, reports):
+    add_transaction(client, 1, 'in', 7)
+    add_transaction(client, 2, 'out', 2)
+    add_sales_order(client, [(1, 4)])
+    add_sales_order(client, [(2, 5)])
+    # The second file starts from a full copy; the third run catches the first file up
+    warehouse.snapshot_reports()
+    warehouse.snapshot_reports()
+
+    client.post('/edit_sales_order/1', data={'status': 'cancelled'})
+    client.post('/edit_transaction/1', data={'product_id': 1, 'transaction_type': 'in', 'quantity': 9})
+    client.post('/delete_transaction/2')
+
+    assert warehouse.snapshot_reports() == {
+        'categories': 0, 'suppliers': 1, 'products': 2, 'sales_orders': 1, 'purchase_orders': 0,
+        'transactions': 1, 'sales_order_items': 1, 'purchase_order_items': 0}
+    assert store_rows('SELECT id, transaction_type, quantity FROM transactions') == [(1, 'in', 9)]
+    assert store_rows('SELECT id, status FROM sales_orders ORDER BY id') == [(1, 'cancelled'), (2, 'pending')]
+    assert dict(store_rows('SELECT id, quantity FROM products')) == quantities(reports)
+
+    rows = client.get('/reports/top_products').get_json()['rows']
+    assert [(row['product_id'], row['units_sold']) for row in rows] == [(2, 5)]
+
+
+def test_full_snapshot_recopies_every_row(client, reports):
+    warehouse.snapshot_reports()
+    warehouse.snapshot_reports()
+    # Written outside the app: no change event names the product
+    sql(reports, "UPDATE products SET name = 'Washer' WHERE id = 2")
+
+    warehouse.snapshot_reports()
+    assert store_rows('SELECT name FROM products WHERE id = 2') == [('Nut',)]
+    assert warehouse.snapshot_reports(full=True)['products'] == 2
+    assert store_rows('SELECT name FROM products WHERE id = 2') == [('Washer',)]
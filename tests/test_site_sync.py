@@ -0,0 +1,66 @@
+import pytest
+
+from conftest import quantities, sql, warehouse
+from storage import SQLiteBackend
+from test_stock_audit import add_transaction
+
+
+# A second SQLite database standing in for the central MySQL one
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    backend = SQLiteBackend(str(tmp_path / 'central.sqlite3'), 2)
+    backend.create_schema()
+    monkeypatch.setattr(warehouse, 'MySQLBackend', lambda config, pool_size: backend)
+    sql(backend, "INSERT INTO categories (id, name) VALUES (4, 'Fasteners')")
+    sql(backend, "INSERT INTO suppliers (id, name, contact_info) VALUES (2, 'Supplier', 's@example.com')")
+    sql(backend, "INSERT INTO customers (id, name, contact_info) VALUES (9, 'Customer', 'c@example.com')")
+    for product in [(3, 'Bolt', 500, 2.15), (8, 'Nut', 70, 0.5)]:
+        sql(backend, '''
+            INSERT INTO products (id, name, category_id, quantity, unit_price, supplier_id) VALUES (%s, %s, 4, %s, %s, 2)
+        ''', product)
+    return backend
+
+
+def pull_catalog():
+    result = warehouse.app.test_cli_runner().invoke(args=['pull-catalog'])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_catalog_writes_are_refused_at_a_site(client, catalog):
+    assert client.post('/add_product', data={'name': 'Washer', 'category_id': 1, 'quantity': 5, 'unit_price': 1,
+                                             'supplier_id': 1}).status_code == 403
+    assert client.post('/edit_product/1', data={'name': 'Bolt', 'category_id': 1, 'quantity': 7, 'unit_price': 2,
+                                                'supplier_id': 1}).status_code == 403
+    assert client.post('/add_customer', data={'name': 'Other', 'contact_info': 'o@example.com'}).status_code == 403
+    assert client.post('/delete_supplier/1').status_code == 403
+    assert quantities(catalog) == {1: 100, 2: 50}
+    assert sql(catalog, 'SELECT COUNT(*) FROM customers') == [(1,)]
+
+
+def test_pull_catalog_copies_rows_with_their_central_ids(client, db, upstream):
+    output = pull_catalog()
+    assert 'products: 2 rows added, 0 updated' in output
+    assert 'customers: 1 rows added, 0 updated' in output
+
+    assert sql(db, 'SELECT id, name, category_id, quantity, unit_price, supplier_id FROM products ORDER BY id') == [
+        (3, 'Bolt', 4, 0, 2.15, 2), (8, 'Nut', 4, 0, 0.5, 2)]
+    assert sql(db, 'SELECT product_id, quantity FROM stock_openings ORDER BY product_id') == [(3, 0), (8, 0)]
+
+    # Orders taken at the site refer to the central rows
+    response = client.post('/add_sales_order', data={'customer_id': 9, 'product_id[]': [8], 'quantity[]': [2]})
+    assert response.status_code == 302
+    assert quantities(db) == {3: 0, 8: -2}
+
+
+def test_pull_catalog_updates_changed_rows_and_keeps_the_site_stock(client, db, upstream):
+    pull_catalog()
+    add_transaction(client, 3, 'in', 5)
+    assert 'products: 0 rows added, 0 updated' in pull_catalog()
+
+    sql(upstream, "UPDATE products SET unit_price = 2.4, quantity = 900 WHERE id = 3")
+    sql(upstream, "UPDATE customers SET contact_info = 'new@example.com' WHERE id = 9")
+    output = pull_catalog()
+    assert 'products: 0 rows added, 1 updated' in output
+    assert 'customers: 0 rows added, 1 updated' in output
+    assert sql(db, 'SELECT quantity, unit_price FROM products WHERE id = 3') == [(5, 2.4)]
@@ -0,0 +1,132 @@
+import pytest
+
+from conftest import quantities, sql, warehouse
+from test_orders import add_purchase_order, add_sales_order
+
+
+@pytest.fixture
+def audited(catalog, monkeypatch):
+    # Every change event counts as settled, so runs pick them up at once
+    monkeypatch.setattr(warehouse, 'CHANGE_FEED_SETTLE_SECONDS', 0)
+    sql(catalog, 'INSERT INTO stock_openings (product_id, quantity) VALUES (1, 100)')
+    sql(catalog, 'INSERT INTO stock_openings (product_id, quantity) VALUES (2, 50)')
+    return catalog
+
+
+def audit(*args):
+    result = warehouse.app.test_cli_runner().invoke(args=['audit-stock', *args])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def movement_sums(db):
+    return dict(sql(db, 'SELECT product_id, moved FROM stock_movement_sums ORDER BY product_id'))
+
+
+def add_transaction(client, product_id, transaction_type, quantity):
+    response = client.post('/add_transaction', data={'product_id': product_id, 'transaction_type': transaction_type,
+                                                     'quantity': quantity})
+    assert response.status_code == 302
+
+
+def test_expected_balance_counts_transactions_and_open_orders(client, audited):
+    add_transaction(client, 1, 'in', 7)
+    add_transaction(client, 1, 'out', 2)
+    add_sales_order(client, [(1, 4), (2, 5)])
+    add_sales_order(client, [(2, 10)])
+    add_purchase_order(client, [(2, 6)])
+    add_purchase_order(client, [(1, 30)])
+    client.post('/edit_sales_order/2', data={'status': 'cancelled'})
+    client.post('/edit_purchase_order/2', data={'status': 'cancelled'})
+    assert quantities(audited) == {1: 101, 2: 51}
+
+    assert 'Audit run 1: 2 products checked, 0 discrepancies, 0 without an opening balance' in audit()
+    assert movement_sums(audited) == {1: 1, 2: 1}
+
+
+def test_drift_is_reported_and_repaired(client, audited):
+    add_sales_order(client, [(1, 4)])
+    sql(audited, 'UPDATE products SET quantity = quantity + 3 WHERE id = 1')
+
+    response = client.get('/audit/stock')
+    assert response.get_json()['discrepancies'] == [
+        {'product_id': 1, 'quantity': 99, 'expected': 96, 'difference': 3}]
+
+    output = audit('--repair')
+    assert 'product 1: quantity 99, expected 96 (+3) repaired' in output
+    assert quantities(audited) == {1: 96, 2: 50}
+    assert '0 discrepancies' in audit()
+
+
+def test_orders_cancelled_as_plain_text_still_hold_their_stock(client, audited):
+    add_sales_order(client, [(1, 4)])
+    sql(audited, "UPDATE sales_orders SET status = 'cancelled' WHERE id = 1")
+
+    assert '0 discrepancies' in audit()
+    assert movement_sums(audited) == {1: -4, 2: 0}
+
+
+def test_products_without_opening_balance_are_not_seeded_by_an_audit(client, catalog):
+    sql(catalog, 'INSERT INTO stock_openings (product_id, quantity) VALUES (2, 50)')
+    add_sales_order(client, [(1, 4)])
+
+    output = audit()
+    assert 'product 1: no opening balance' in output
+    assert '1 without an opening balance' in output
+    assert client.post('/audit/stock').get_json()['no_baseline'] == [1]
+    assert sql(catalog, 'SELECT product_id FROM stock_openings') == [(2,)]
+
+    assert 'Recorded opening balances for 1 products' in audit('--seed-openings')
+    # The current quantity, 96 after 4 units sold, is accepted as correct
+    assert sql(catalog, 'SELECT quantity FROM stock_openings WHERE product_id = 1') == [(100,)]
+    assert '0 discrepancies, 0 without an opening balance' in audit()
+
+
+def test_later_runs_pick_up_new_edited_and_cancelled_movements(client, audited):
+    add_transaction(client, 1, 'in', 5)
+    add_sales_order(client, [(2, 8)])
+    audit()
+    assert movement_sums(audited) == {1: 5, 2: -8}
+
+    add_transaction(client, 2, 'in', 4)
+    client.post('/edit_transaction/1', data={'product_id': 1, 'transaction_type': 'out', 'quantity': 5})
+    client.post('/edit_sales_order/1', data={'status': 'cancelled'})
+    add_purchase_order(client, [(1, 2)])
+    client.post('/delete_transaction/2')
+
+    assert '0 discrepancies' in audit()
+    assert movement_sums(audited) == {1: -3, 2: 0}
+    assert quantities(audited) == {1: 97, 2: 50}
+
+
+def test_movements_without_change_events_are_added_from_the_marks(client, audited):
+    audit()
+    marks = dict(sql(audited, 'SELECT source, last_id FROM stock_audit_marks'))
+
+    # Written outside the app: no change event names the product
+    sql(audited, "INSERT INTO transactions (product_id, transaction_type, quantity) VALUES (2, 'out', 6)")
+    sql(audited, 'UPDATE products SET quantity = quantity - 6 WHERE id = 2')
+
+    assert '0 discrepancies' in audit()
+    assert movement_sums(audited) == {1: 0, 2: -6}
+    assert dict(sql(audited, 'SELECT source, last_id FROM stock_audit_marks'))['transactions'] == marks['transactions'] + 1
+
+
+def test_stale_sums_are_checked_again_before_reporting(client, audited):
+    audit()
+    sql(audited, 'UPDATE stock_movement_sums SET moved = moved + 9 WHERE product_id = 1')
+
+    assert '0 discrepancies' in audit()
+    assert movement_sums(audited) == {1: 0, 2: 0}
+
+
+def test_interrupted_run_resumes_after_the_last_chunk(client, audited):
+    conn = audited.connect()
+    run_id = warehouse.execute(conn, warehouse.INSERT_AUDIT_RUN_QUERY, (False,)).lastrowid
+    warehouse.execute(conn, warehouse.UPDATE_AUDIT_RUN_QUERY, (1, 1, 0, run_id))
+    conn.commit()
+    conn.close()
+
+    output = audit('--chunk-size', '1')
+    assert f'Resuming audit run {run_id} after product 1' in output
+    assert f'Audit run {run_id}: 1 products checked' in output